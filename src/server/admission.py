@@ -0,0 +1,152 @@
+import heapq
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class QueueFullError(Exception):
+    """Raised, or set on a queued future, when work is shed; retry_after is in seconds"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Queue is full, retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class QuotaStore:
+    """Token bucket state in a SQLite file, so every worker process on the host draws from the same buckets"""
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connection(self):
+        # One connection per thread, reopened after a fork
+        if getattr(self.local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, name, rate, burst, count, reserve=True):
+        """Return the seconds until count tokens are available, taking them now when reserve is set
+
+        A reservation may leave the bucket negative; the caller waits out the returned delay
+        before using what it reserved, which keeps later callers queued behind it.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (name,)).fetchone()
+            now = time.time()
+            tokens = burst if row is None else min(burst, row[0] + (now - row[1]) * rate)
+            delay = max(0.0, (count - tokens) / rate)
+            if reserve:
+                connection.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)',
+                                   (name, tokens - count, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return delay
+
+
+class TokenBucket:
+    """Rate limit for one upstream, e.g. Azure Read transactions per second or Gemini requests"""
+
+    def __init__(self, store, name, rate, burst):
+        self.store = store
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def reserve(self, count=1):
+        """Take count tokens and return how long to wait before using them"""
+        return self.store.take(self.name, self.rate, self.burst, count)
+
+    def delay_for(self, count=1):
+        """Return how long count tokens would take to become available, without taking them"""
+        return self.store.take(self.name, self.rate, self.burst, count, reserve=False)
+
+    def wait(self, count=1):
+        time.sleep(self.reserve(count))
+
+
+class PriorityScheduler:
+    """Runs work on a fixed set of threads from a bounded queue, lowest priority number first
+
+    When the queue is full, new work displaces the lowest-priority queued item if it outranks
+    it, and is shed otherwise. Shed work gets a QueueFullError whose retry_after is estimated
+    from the queue ahead and the running average service time. Threads start on first submit.
+    """
+
+    def __init__(self, workers, capacity):
+        self.workers = workers
+        self.capacity = capacity
+        self.queue = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.active = 0
+        self.service_time = 1.0
+        self.threads = []
+
+    def _start(self):
+        if not self.threads:
+            self.threads = [threading.Thread(target=self._run, name=f'scheduler-{i}', daemon=True)
+                            for i in range(self.workers)]
+            for thread in self.threads:
+                thread.start()
+
+    def wait_estimate(self, priority):
+        """Seconds until work submitted now at priority would start"""
+        with self.condition:
+            ahead = sum(1 for item in self.queue if item[0] <= priority)
+            busy = self.active + ahead
+        return math.floor(busy / self.workers) * self.service_time
+
+    def submit(self, priority, fn, *args, **kwargs):
+        future = Future()
+        displaced = None
+        with self.condition:
+            self._start()
+            if len(self.queue) >= self.capacity:
+                worst = max(self.queue)
+                if worst[0] <= priority:
+                    raise QueueFullError(self._retry_after(len(self.queue)))
+                self.queue.remove(worst)
+                heapq.heapify(self.queue)
+                displaced = worst[2], QueueFullError(self._retry_after(len(self.queue)))
+            heapq.heappush(self.queue, (priority, next(self.counter), future, fn, args, kwargs))
+            self.condition.notify()
+        # Done callbacks run synchronously, so they must not run under the scheduler lock
+        if displaced:
+            displaced[0].set_exception(displaced[1])
+        return future
+
+    def _retry_after(self, queued):
+        return max(1.0, (queued + self.active) / self.workers * self.service_time)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                _, _, future, fn, args, kwargs = heapq.heappop(self.queue)
+                if not future.set_running_or_notify_cancel():
+                    continue
+                self.active += 1
+            start = time.monotonic()
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.condition:
+                    self.active -= 1
+                    # Exponentially weighted so the estimate follows the current load
+                    self.service_time = 0.8 * self.service_time + 0.2 * (time.monotonic() - start)
@@ -1,33 +1,133 @@
+import asyncio
+import copy
+import hashlib
+import logging
 import os
+import random
 import time
-from flask import Flask, request, jsonify, send_from_directory, send_file
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.errors import PyMongoError
 from azure.cognitiveservices.vision.computervision import ComputerVisionClient
-from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes
 from msrest.authentication import CognitiveServicesCredentials
-from ultralytics import YOLO
-import google.generativeai as genai
 from dotenv import load_dotenv
-import cv2
+import numpy as np
 import json
+import math
 from datetime import datetime
 from bson import ObjectId
+from bson.errors import InvalidId
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+from admission import PriorityScheduler, QueueFullError, QuotaStore, TokenBucket
+from detection_batcher import DetectionBatcher
+from face_index import FaceIndex, create_face_embedder
+from face_store import FaceStore
+from gemini_client import AsyncGeminiModel
+from http_pool import AsyncHTTPPool, parse_host_limits
+from id_fields import PATTERN_VERSION, extract_id_fields
+from lazy import LazyModule, LazyResource, warm_up
+from metrics import instrumented, record_error, record_tokens, scrape_registry, track_stage
+from pdf_pages import is_pdf, rasterize_pages
+from preprocess import prepare_image
+from ocr_backends import AsyncAzureReadBackend, AzureReadBackend, FixtureBackend, RoutingBackend, TesseractBackend
+from result_cache import create_result_cache
 
 # Load environment variables
 load_dotenv()
 
+# OpenCV (and ultralytics/torch, imported by the YOLO loader) are only imported when first needed
+cv2 = LazyModule('cv2')
+
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-After'])
 
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 FACES_FOLDER = 'faces'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB limit
+FACE_THUMBNAIL_SIZE = int(os.getenv('FACE_THUMBNAIL_SIZE', '128'))  # longest edge of face thumbnails in pixels
+FACE_CACHE_MAX_AGE = int(os.getenv('FACE_CACHE_MAX_AGE', str(365 * 24 * 3600)))  # seconds
+FACE_INDEX_DIR = os.getenv('FACE_INDEX_DIR', 'face_index')
+FACE_EMBEDDING_MODEL = os.getenv('FACE_EMBEDDING_MODEL')  # SFace ONNX model; unset embeds downscaled pixels
+FACE_INDEX_LISTS = int(os.getenv('FACE_INDEX_LISTS', '256'))  # inverted lists (k-means centroids)
+FACE_INDEX_NPROBE = int(os.getenv('FACE_INDEX_NPROBE', '8'))  # lists scanned per search
+FACE_INDEX_TRAIN_SIZE = int(os.getenv('FACE_INDEX_TRAIN_SIZE', '8192'))  # faces stored before the lists are built
+FACE_INDEX_EMPTY_GRACE = float(os.getenv('FACE_INDEX_EMPTY_GRACE', '60'))  # seconds before an unwritten row is skipped
+FACE_SIMILAR_MAX_K = int(os.getenv('FACE_SIMILAR_MAX_K', '100'))
+FACES_ACCEL_REDIRECT = os.getenv('FACES_ACCEL_REDIRECT')  # internal proxy location for FACES_FOLDER, e.g. /protected-faces/
+FACES_X_SENDFILE = os.getenv('FACES_X_SENDFILE', 'false').lower() in ('1', 'true', 'yes')  # let the proxy send face files
+OCR_BACKEND = os.getenv('OCR_BACKEND', 'azure')  # azure, tesseract, fixture or routed (tesseract first, azure for hard cases)
+OCR_LOCAL_WORKERS = int(os.getenv('OCR_LOCAL_WORKERS', '2'))  # concurrent Tesseract processes
+OCR_LOCAL_MAX_PIXELS = int(os.getenv('OCR_LOCAL_MAX_PIXELS', '2000000'))  # largest image the router sends to Tesseract
+OCR_LOCAL_MIN_CONFIDENCE = float(os.getenv('OCR_LOCAL_MIN_CONFIDENCE', '80'))  # mean word confidence to accept local text
+OCR_FIXTURE_DIR = os.getenv('OCR_FIXTURE_DIR', 'ocr_fixtures')
+OCR_FIXTURE_LATENCY = float(os.getenv('OCR_FIXTURE_LATENCY', '0'))  # simulated seconds per fixture read
+OCR_FIXTURE_RECORD = os.getenv('OCR_FIXTURE_RECORD')  # backend used to record fixtures on a miss, e.g. azure
+OCR_MAX_EDGE = int(os.getenv('OCR_MAX_EDGE', '2048'))  # longest edge of images sent to Azure, in pixels
+DETECTION_IMAGE_SIZE = int(os.getenv('DETECTION_IMAGE_SIZE', '640'))  # longest edge of images given to YOLO
+PDF_DPI = int(os.getenv('PDF_DPI', '150'))  # rasterization resolution for face detection on PDF pages
+PDF_MAX_PAGES = int(os.getenv('PDF_MAX_PAGES', '20'))  # pages scanned for faces per PDF (0 = all)
+PDF_STOP_AT_FIRST_FACE = os.getenv('PDF_STOP_AT_FIRST_FACE', 'true').lower() in ('1', 'true', 'yes')
+RETAIN_UPLOADS = os.getenv('RETAIN_UPLOADS', 'false').lower() in ('1', 'true', 'yes')  # keep originals in UPLOAD_FOLDER
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+OCR_WORKERS = int(os.getenv('OCR_WORKERS', '8'))  # concurrent OCR calls per process for blocking backends
+DETECTION_WORKERS = int(os.getenv('DETECTION_WORKERS', '4'))  # concurrent image decodes per process
+DETECTION_BATCH_SIZE = int(os.getenv('DETECTION_BATCH_SIZE', '8'))  # max images per YOLO call
+DETECTION_BATCH_WAIT = float(os.getenv('DETECTION_BATCH_WAIT', '0.05'))  # seconds to wait for a batch to fill
+DOCUMENTS_PAGE_SIZE = int(os.getenv('DOCUMENTS_PAGE_SIZE', '50'))  # default page for /api/documents/<user_id>
+DOCUMENTS_MAX_PAGE_SIZE = int(os.getenv('DOCUMENTS_MAX_PAGE_SIZE', '500'))
+JOB_STREAM_INTERVAL = float(os.getenv('JOB_STREAM_INTERVAL', '0.5'))  # seconds between progress events
+OCR_CACHE_BACKEND = os.getenv('OCR_CACHE_BACKEND', 'memory')  # memory, disk, mongo or none
+OCR_CACHE_TTL = float(os.getenv('OCR_CACHE_TTL', str(7 * 24 * 3600)))  # seconds
+OCR_CACHE_MAX_ENTRIES = int(os.getenv('OCR_CACHE_MAX_ENTRIES', '1024'))
+EXTRACTION_CACHE_BACKEND = os.getenv('EXTRACTION_CACHE_BACKEND', 'memory')  # memory, disk, mongo or none
+EXTRACTION_CACHE_TTL = float(os.getenv('EXTRACTION_CACHE_TTL', str(7 * 24 * 3600)))  # seconds
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', '1024'))
+# Fields that must be filled before Gemini can be skipped, as "Section:Field" separated by ";" (default: all)
+EXTRACTION_REQUIRED_FIELDS = os.getenv('EXTRACTION_REQUIRED_FIELDS')
+EXTRACTION_OCR_TOKEN_BUDGET = int(os.getenv('EXTRACTION_OCR_TOKEN_BUDGET', '2000'))  # OCR text tokens per Gemini prompt (0 = no limit)
+# background: load models and clients on a thread after startup; lazy: on first use;
+# preload: load the models at import so a pre-forking server (e.g. gunicorn --preload) shares them copy-on-write
+WARMUP_MODE = os.getenv('WARMUP_MODE', 'background')
+WARMUP_RETRY_INTERVAL = float(os.getenv('WARMUP_RETRY_INTERVAL', '30'))  # seconds between retries of failed warmups
+# Azure Read and Gemini go through a shared keep-alive aiohttp pool; false uses the blocking SDK clients
+HTTP_ASYNC_CLIENTS = os.getenv('HTTP_ASYNC_CLIENTS', 'true').lower() in ('1', 'true', 'yes')
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))  # open connections per process
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '32'))  # open connections per upstream host
+HTTP_HOST_LIMITS = parse_host_limits(os.getenv('HTTP_HOST_LIMITS'))  # concurrent requests per host, "host=n;host=n"
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', '30'))  # seconds an idle connection is kept
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '30'))  # seconds per request
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '5'))
+# Upstream quotas, shared by all worker processes on the host through QUOTA_STORE
+QUOTA_STORE = os.getenv('QUOTA_STORE', 'quota.sqlite3')
+AZURE_READ_RATE = float(os.getenv('AZURE_READ_RATE', '10'))  # Read transactions (submits and polls) per second
+AZURE_READ_BURST = float(os.getenv('AZURE_READ_BURST', '10'))
+GEMINI_RATE = float(os.getenv('GEMINI_RATE', '15')) / 60  # GEMINI_RATE is in requests per minute
+GEMINI_BURST = float(os.getenv('GEMINI_BURST', '5'))
+UPLOAD_QUEUE_SIZE = int(os.getenv('UPLOAD_QUEUE_SIZE', '64'))  # uploads waiting for a JOB_WORKERS slot
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', '60'))  # shed uploads expected to wait longer, in seconds
+# Queue priorities, lowest first; an upload is a re-check when it names one of the user's documents
+# with ?recheck=<document id> or a "recheck" form field
+UPLOAD_PRIORITIES = {'recheck': 0, 'upload': 1}
+# auto: write each upload's document and faces in one transaction when MongoDB is a replica set or sharded cluster
+MONGO_TRANSACTIONS = os.getenv('MONGO_TRANSACTIONS', 'auto').lower()
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.01'))  # fraction of requests whose OCR/Gemini text is logged at DEBUG
+
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('equichain')
+
+def log_sampled(message, *args):
+    """Log a verbose DEBUG dump for a sampled fraction of calls; args are only formatted when emitted"""
+    if logger.isEnabledFor(logging.DEBUG) and random.random() < LOG_SAMPLE_RATE:
+        logger.debug(message, *args)
 
 # Create necessary directories
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -35,32 +135,163 @@ os.makedirs(FACES_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
+app.config['USE_X_SENDFILE'] = FACES_X_SENDFILE
 
-# Initialize MongoDB client
-mongo_client = MongoClient(os.getenv('MONGODB_URI'))
+# Initialize MongoDB client; the connection is opened on first use, so it is safe to fork after import
+mongo_client = MongoClient(os.getenv('MONGODB_URI'), connect=False)
 db = mongo_client['equichain']
+jobs_collection = db['jobs']
+
+# Shared collections for all users, indexed for per-user listing in time order
+documents_collection = db['documents']
+faces_collection = db['faces']
+
+def create_indexes():
+    documents_collection.create_index([('user_id', ASCENDING), ('timestamp', ASCENDING)])
+    faces_collection.create_index([('user_id', ASCENDING), ('timestamp', ASCENDING)])
+    faces_collection.create_index([('user_id', ASCENDING), ('document_filename', ASCENDING)])
+    faces_collection.create_index([('document_id', ASCENDING)], sparse=True)
+    faces_collection.create_index([('embedder', ASCENDING), ('embedding_row', ASCENDING)], sparse=True)
+    return True
+
+mongo_indexes = LazyResource('mongo', create_indexes)
+
+def detect_transaction_support():
+    if MONGO_TRANSACTIONS in ('0', 'false', 'no'):
+        return False
+    if MONGO_TRANSACTIONS in ('1', 'true', 'yes'):
+        return True
+    # Standalone servers reject transactions; replica set members report setName, mongos reports isdbgrid
+    hello = mongo_client.admin.command('hello')
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+mongo_transactions = LazyResource('mongo_transactions', detect_transaction_support)
+
+# Content-addressed face crops, reference-counted in face_blobs
+face_store = FaceStore(FACES_FOLDER, db['face_blobs'], FACE_THUMBNAIL_SIZE)
+
+# Face embeddings for similar-face lookup; each embedder gets its own matrix and row counter
+face_embedder = create_face_embedder(FACE_EMBEDDING_MODEL)
+face_index = FaceIndex(os.path.join(FACE_INDEX_DIR, face_embedder.name), face_embedder.dim, db['counters'],
+                       f'face_index:{face_embedder.name}', FACE_INDEX_LISTS, FACE_INDEX_NPROBE, FACE_INDEX_TRAIN_SIZE,
+                       FACE_INDEX_EMPTY_GRACE)
+
+# Shared connection pool for the async Azure Read and Gemini clients; its loop thread starts on first use
+http_pool = AsyncHTTPPool(HTTP_POOL_SIZE, HTTP_POOL_PER_HOST, HTTP_KEEPALIVE, HTTP_TIMEOUT,
+                          HTTP_CONNECT_TIMEOUT, HTTP_HOST_LIMITS)
+
+# Token buckets reflecting the Azure Read and Gemini rate limits
+quota_store = QuotaStore(QUOTA_STORE)
+azure_quota = TokenBucket(quota_store, 'azure_read', AZURE_READ_RATE, AZURE_READ_BURST)
+gemini_quota = TokenBucket(quota_store, 'gemini', GEMINI_RATE, GEMINI_BURST)
 
 # Initialize Azure Computer Vision client
-azure_client = ComputerVisionClient(
+azure_client = LazyResource('azure', lambda: ComputerVisionClient(
     endpoint=os.getenv('AZURE_ENDPOINT'),
     credentials=CognitiveServicesCredentials(os.getenv('AZURE_KEY'))
-)
+))
+
+# Initialize OCR backend
+def create_azure_backend():
+    if HTTP_ASYNC_CLIENTS:
+        return AsyncAzureReadBackend(http_pool, os.getenv('AZURE_ENDPOINT'), os.getenv('AZURE_KEY'), azure_quota)
+    return AzureReadBackend(azure_client, azure_quota)
+
+def create_ocr_backend(name):
+    if name == 'azure':
+        return create_azure_backend()
+    if name == 'tesseract':
+        return TesseractBackend(OCR_LOCAL_WORKERS)
+    if name == 'fixture':
+        fallback = create_ocr_backend(OCR_FIXTURE_RECORD) if OCR_FIXTURE_RECORD else None
+        return FixtureBackend(OCR_FIXTURE_DIR, OCR_FIXTURE_LATENCY, fallback)
+    if name == 'routed':
+        return RoutingBackend(TesseractBackend(OCR_LOCAL_WORKERS), create_azure_backend(),
+                              OCR_LOCAL_MAX_PIXELS, OCR_LOCAL_MIN_CONFIDENCE)
+    raise ValueError(f"Unknown OCR backend: {name}")
+
+ocr_backend = create_ocr_backend(OCR_BACKEND)
 
 # Initialize Gemini
-genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
-model = genai.GenerativeModel('gemini-2.0-flash')
+def load_gemini():
+    if HTTP_ASYNC_CLIENTS:
+        return AsyncGeminiModel(http_pool, os.getenv('GEMINI_API_KEY'), 'gemini-2.0-flash')
+    import google.generativeai as genai
+    genai.configure(api_key=os.getenv('GEMINI_API_KEY'))
+    return genai.GenerativeModel('gemini-2.0-flash')
+
+model = LazyResource('gemini', load_gemini)
+
+# Initialize result caches for OCR text and Gemini extractions
+ocr_cache = create_result_cache('ocr_cache', OCR_CACHE_BACKEND, OCR_CACHE_MAX_ENTRIES, OCR_CACHE_TTL, db)
+extraction_cache = create_result_cache(
+    'extraction_cache', EXTRACTION_CACHE_BACKEND, EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_CACHE_TTL, db
+)
 
 # Initialize YOLO
-yolo_model = YOLO("yolov8n.pt")
+def load_yolo():
+    from ultralytics import YOLO
+    return YOLO("yolov8n.pt")
+
+yolo_model = LazyResource('yolo', load_yolo)
+
+# Images from all concurrent uploads share batched YOLO calls on one inference thread
+detection_batcher = DetectionBatcher(lambda images: yolo_model.get()(images), DETECTION_BATCH_SIZE, DETECTION_BATCH_WAIT)
+
+# Touching any attribute imports OpenCV
+opencv = LazyResource('opencv', lambda: cv2.imdecode)
+
+# Model loads and client setup, in warmup order; the SDK Azure client is unused when the async clients are on
+components = [yolo_model, opencv, mongo_indexes] + ([] if HTTP_ASYNC_CLIENTS else [azure_client]) + [model]
+
+# Loaded before the fork in preload mode
+preloaded_components = [yolo_model, opencv]
+
+if WARMUP_MODE == 'preload':
+    # Only the models: network clients are created in each worker after the fork, see warm_up_worker
+    warm_up(preloaded_components, background=False)
+elif WARMUP_MODE == 'background':
+    warm_up(components, retry_interval=WARMUP_RETRY_INTERVAL)
+elif WARMUP_MODE != 'lazy':
+    raise ValueError(f"Unknown WARMUP_MODE: {WARMUP_MODE}")
+
+# Components readiness waits for: lazy mode loads on demand, so it is ready from the start
+ready_components = [] if WARMUP_MODE == 'lazy' else components
+warmup_pid = None
+
+# Background workers for asynchronous uploads
+# Uploads, synchronous or not, run on JOB_WORKERS threads in priority order
+upload_scheduler = PriorityScheduler(JOB_WORKERS, UPLOAD_QUEUE_SIZE)
+
+# Per-file stage pools shared by all uploads
+ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+detection_executor = ThreadPoolExecutor(max_workers=DETECTION_WORKERS, thread_name_prefix='detection')
 
 # Initialize rate limiter
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["5 per minute"],
-    storage_uri="memory://"
+    storage_uri=os.getenv('RATELIMIT_STORAGE_URI', 'memory://')  # e.g. redis:// to share limits across processes
 )
 
+@app.before_request
+def warm_up_worker():
+    """Start this worker's background setup on its first request, without waiting for it
+
+    Preload mode sets up the network clients after the fork; lazy mode only creates the
+    Mongo indexes, which no request loads on demand. Failures are retried in the background.
+    """
+    global warmup_pid
+    if WARMUP_MODE == 'background' or warmup_pid == os.getpid():
+        return
+    warmup_pid = os.getpid()
+    if WARMUP_MODE == 'preload':
+        pending = [component for component in components if component not in preloaded_components]
+    else:
+        pending = [mongo_indexes]
+    warm_up(pending, retry_interval=WARMUP_RETRY_INTERVAL)
+
 # Error handlers
 @app.errorhandler(413)
 def request_entity_too_large(error):
@@ -80,160 +311,543 @@ def ratelimit_handler(error):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def process_ocr(file_path):
-    """Process OCR using Azure Computer Vision"""
-    print(f"\nProcessing OCR for file: {file_path}")
-    with open(file_path, "rb") as image_stream:
-        raw_response = azure_client.read_in_stream(image_stream, language="en", raw=True)
-        operation_location = raw_response.headers["Operation-Location"]
-        operation_id = operation_location.split("/")[-1]
-
-    while True:
-        result = azure_client.get_read_result(operation_id)
-        if result.status not in ['notStarted', 'running']:
-            break
-        time.sleep(1)
-
-    if result.status == OperationStatusCodes.succeeded:
-        all_text = ""
-        for page in result.analyze_result.read_results:
-            for line in page.lines:
-                all_text += line.text + "\n"
-        print(f"OCR Text extracted: {all_text[:100]}...")  # Print first 100 chars
+@instrumented('ocr')
+def process_ocr(image_data, language="en", cache_data=None):
+    """Process OCR using the configured OCR backend
+
+    cache_data is the original upload when image_data is a normalized copy of it, so the
+    cache stays keyed by what the user sent.
+    """
+    logger.info("Processing OCR for %d bytes", len(image_data))
+
+    # Identical bytes in the same language always produce the same text
+    cache_key = ocr_cache.key(cache_data or image_data, language)
+    cached_text = ocr_cache.get(cache_key)
+    if cached_text is not None:
+        logger.info("OCR cache hit")
+        return cached_text
+
+    all_text = ocr_backend.read(image_data, language)
+    if all_text is None:
+        return ""
+    log_sampled("OCR Text extracted: %s...", all_text[:100])
+    ocr_cache.set(cache_key, all_text)
+    return all_text
+
+async def process_ocr_async(image_data, language="en", cache_data=None):
+    """process_ocr for backends with read_async, run on http_pool's loop
+
+    Only the cache lookups borrow a thread; the remote read and its polls are awaited.
+    """
+    with track_stage('ocr'):
+        logger.info("Processing OCR for %d bytes", len(image_data))
+
+        cache_key = ocr_cache.key(cache_data or image_data, language)
+        cached_text = await asyncio.to_thread(ocr_cache.get, cache_key)
+        if cached_text is not None:
+            logger.info("OCR cache hit")
+            return cached_text
+
+        all_text = await ocr_backend.read_async(image_data, language)
+        if all_text is None:
+            return ""
+        log_sampled("OCR Text extracted: %s...", all_text[:100])
+        await asyncio.to_thread(ocr_cache.set, cache_key, all_text)
         return all_text
-    print("OCR processing failed")
-    return ""
 
-def detect_faces(file_path):
-    """Detect faces using YOLOv8"""
+def submit_ocr(image_data, language="en", cache_data=None):
+    """Start OCR and return a Future of the text
+
+    Backends with read_async run on http_pool without holding a thread while the read is in
+    flight; the others run process_ocr on ocr_executor.
+    """
+    if hasattr(ocr_backend, 'read_async'):
+        return http_pool.submit(process_ocr_async(image_data, language, cache_data))
+    return ocr_executor.submit(process_ocr, image_data, language, cache_data)
+
+def person_boxes(boxes, width, height, scale=1.0):
+    """Return class-0 ("person" in COCO) boxes as an (n, 4) int array clipped to a width x height image
+
+    Boxes detected on a copy resized by scale are mapped back by dividing by it.
+    """
+    xyxy = boxes.xyxy.cpu().numpy()
+    cls = boxes.cls.cpu().numpy()
+    xyxy = xyxy[cls == 0] / scale
+    xyxy = np.clip(xyxy, 0, [width, height, width, height]).astype(np.int32)
+    # Drop boxes that collapsed to nothing after clipping
+    return xyxy[(xyxy[:, 2] > xyxy[:, 0]) & (xyxy[:, 3] > xyxy[:, 1])]
+
+def encode_faces(img, detection_img=None, scale=1.0):
+    """Run an image (or its resized detection copy) through YOLO and return the person crops as JPEG bytes"""
+    results = detection_batcher.submit(img if detection_img is None else detection_img).result()
+    height, width = img.shape[:2]
+    crops = [img[y1:y2, x1:x2] for x1, y1, x2, y2 in person_boxes(results.boxes, width, height, scale)]
+    return [cv2.imencode('.jpg', crop)[1].tobytes() for crop in crops]
+
+@instrumented('detection')
+def detect_faces(prepared):
+    """Detect faces using YOLOv8 on a PreparedImage and return the crops as JPEG bytes"""
     faces = []
     try:
-        img = cv2.imread(file_path)
-        if img is None:
-            return faces
-        
-        results = yolo_model(img)[0]
-        for box, cls in zip(results.boxes.xyxy, results.boxes.cls):
-            class_id = int(cls.item())
-            if class_id == 0:  # class 0 is "person" in COCO
-                x1, y1, x2, y2 = map(int, box)
-                face_count = len(faces) + 1
-                face_img = img[y1:y2, x1:x2]
-                face_path = f"face_{face_count}.jpg"
-                cv2.imwrite(os.path.join(FACES_FOLDER, face_path), face_img)
-                faces.append(face_path)
+        if prepared.image is not None:
+            return encode_faces(prepared.image, prepared.detection_image, prepared.scale)
+
+        if is_pdf(prepared.data):
+            # Pages are rendered one at a time as detection asks for them
+            for page in rasterize_pages(prepared.data, PDF_DPI, PDF_MAX_PAGES):
+                faces.extend(encode_faces(page))
+                if faces and PDF_STOP_AT_FIRST_FACE:
+                    break
     except Exception as e:
-        print(f"Face detection error: {e}")
+        record_error('detection')
+        logger.error("Face detection error: %s", e)
     return faces
 
+FIELD_INSTRUCTIONS = {
+    "Personal Information": {
+        "Full Name": "extract the full name (look for patterns like 'Name:', 'Full Name:', or text before 'DOB:')",
+        "Date of Birth": "extract date of birth in DD/MM/YYYY format (look for 'DOB:', 'Date of Birth:', or similar patterns)",
+        "Age": "calculate age from date of birth",
+        "Gender": "extract gender (look for 'Gender:', 'Sex:', or M/F indicators)",
+        "Mobile Number": "extract the mobile number (look for 10-digit numbers, patterns like 'Mobile:', 'Phone:')",
+        "Father's Name": "extract father's name (look for 'Father:', 'Father's Name:', or similar patterns)",
+        "Caste": "extract caste information (look for 'Caste:', 'Category:', or similar terms)"
+    },
+    "Aadhaar Details": {
+        "Aadhaar Number": "extract the 12-digit Aadhaar number (look for 12 digits in groups of 4)",
+        "VID": "extract the 16-digit VID number (look for 16 digits after 'VID:')",
+        "Address": "extract the complete address (look for text after 'Address:', 'C/O:', or similar patterns)",
+        "Issue Date": "extract the issue date in DD/MM/YYYY format (look for 'Issue Date:', 'Date of Issue:', or similar patterns)"
+    },
+    "PAN Details": {
+        "PAN Number": "extract the Permanent Account Number (look for 'Permanent Account Number' or 'PAN' followed by 10 characters in format AAAAA9999A, or 5 letters followed by 4 numbers and 1 letter)"
+    },
+    "Financial Information": {
+        "Annual Income": "extract the annual income (look for patterns like 'Annual Income:', 'Income:', 'Rs.', 'INR', '₹', or numbers followed by 'per annum', 'p.a.', 'PA', 'Lakh', 'Lac', 'Crore')"
+    }
+}
+
+EXTRACTION_PROMPT = """Extract these fields from the OCR text of Indian identity documents. Use null for a field that is not present.
+Write dates as DD/MM/YYYY, income as a plain number ('5 Lakh' -> 500000) and age as computed from the date of birth.
+Remove extra spaces and stray symbols from values.
+
+Fields:
+{fields}
+
+OCR text:
+{ocr_text}
+"""
+
+if EXTRACTION_REQUIRED_FIELDS:
+    REQUIRED_FIELDS = {tuple(field.strip().split(':', 1)) for field in EXTRACTION_REQUIRED_FIELDS.split(';')}
+else:
+    REQUIRED_FIELDS = {(section, key) for section, instructions in FIELD_INSTRUCTIONS.items() for key in instructions}
+
+# Editing the prompt, field list, local patterns or required fields changes the version and so invalidates memoized extractions
+EXTRACTION_PROMPT_VERSION = hashlib.sha256(
+    (EXTRACTION_PROMPT + json.dumps(FIELD_INSTRUCTIONS, sort_keys=True) + PATTERN_VERSION
+     + repr(sorted(REQUIRED_FIELDS)) + str(EXTRACTION_OCR_TOKEN_BUDGET)).encode()
+).hexdigest()[:12]
+
+def normalize_ocr_text(ocr_text):
+    """Collapse whitespace and drop blank lines so cosmetic OCR differences share a cache key"""
+    lines = (' '.join(line.split()) for line in ocr_text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+# Roughly four characters per token for the mostly Latin OCR text of these documents
+CHARS_PER_TOKEN = 4
+
+def compact_ocr_text(ocr_text, max_tokens=EXTRACTION_OCR_TOKEN_BUDGET):
+    """Shrink OCR text for the prompt: normalized, repeated and noise lines dropped, cut to max_tokens
+
+    The budget is shared between the "=== Document: ... ===" sections of a multi-file upload:
+    sections shorter than an equal share keep all their text and what they leave over goes to
+    the longer ones, so a long first document cannot push the others out of the prompt.
+    """
+    seen = set()
+    sections = [[]]
+    for line in normalize_ocr_text(ocr_text).splitlines():
+        if line.startswith('=== Document:'):
+            sections.append([line])
+            continue
+        key = line.casefold()
+        # Lines repeated across pages or documents (headers, footers) and symbol-only lines carry nothing;
+        # single letters stay, since a lone M or F is how cards print gender
+        if key in seen or not any(char.isalnum() for char in line):
+            continue
+        seen.add(key)
+        sections[-1].append(line)
+    sections = [section for section in sections if section]
+    if not max_tokens:
+        return '\n'.join(line for section in sections for line in section)
+
+    sizes = [sum(len(line) + 1 for line in section) for section in sections]
+    budgets = [0] * len(sections)
+    remaining = max_tokens * CHARS_PER_TOKEN
+    for position, i in enumerate(sorted(range(len(sections)), key=sizes.__getitem__)):
+        budgets[i] = min(sizes[i], remaining // (len(sections) - position))
+        remaining -= budgets[i]
+
+    lines = []
+    for section, size, budget in zip(sections, sizes, budgets):
+        used = 0
+        for line in section:
+            if used + len(line) + 1 > budget:
+                logger.warning("OCR text cut to %d of %d characters for the prompt%s", used, size,
+                               f" in {section[0][3:-3].strip()}" if section[0].startswith('=== ') else '')
+                break
+            lines.append(line)
+            used += len(line) + 1
+    return '\n'.join(lines)
+
+def extraction_schema(fields):
+    """Gemini response schema: one object per section with a nullable string per field"""
+    return {
+        'type': 'OBJECT',
+        'properties': {
+            section: {
+                'type': 'OBJECT',
+                'properties': {key: {'type': 'STRING', 'nullable': True} for key in instructions},
+                'required': list(instructions)
+            }
+            for section, instructions in fields.items()
+        },
+        'required': list(fields)
+    }
+
+def request_gemini_fields(ocr_text, fields):
+    """Ask Gemini for the given {section: {field: instruction}} subset and return the cleaned values"""
+    prompt = EXTRACTION_PROMPT.format(ocr_text=compact_ocr_text(ocr_text),
+                                      fields=json.dumps(fields, ensure_ascii=False, separators=(',', ':')))
+    generation_config = {'response_mime_type': 'application/json', 'response_schema': extraction_schema(fields)}
+
+    gemini_quota.wait()
+    with track_stage('gemini'):
+        response = model.get().generate_content(prompt, generation_config=generation_config)
+    log_sampled("Gemini Response:\n%s", response.text)
+
+    usage = getattr(response, 'usage_metadata', None)
+    input_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+    record_tokens('gemini', input_tokens, output_tokens)
+    logger.info("Gemini call used %d input and %d output tokens", input_tokens, output_tokens)
+
+    # The response schema makes the whole response text one JSON object
+    extracted_data = json.loads(response.text)
+    if not isinstance(extracted_data, dict):
+        raise ValueError("Gemini response is not a JSON object")
+
+    # Clean and standardize the data
+    for section in extracted_data:
+        for key, value in extracted_data[section].items():
+            if isinstance(value, str):
+                extracted_data[section][key] = value.strip()
+            if value == "":
+                extracted_data[section][key] = None
+
+            # Format income if present
+            if key == "Annual Income" and value:
+                # Remove currency symbols and convert to standard format
+                value = value.replace('₹', '').replace('Rs.', '').replace('INR', '').strip()
+                # Remove 'per annum' or similar text
+                value = value.split('per')[0].strip()
+                # Convert Lakh/Lac to numbers
+                if 'Lakh' in value or 'Lac' in value:
+                    value = value.replace('Lakh', '').replace('Lac', '').strip()
+                    value = str(float(value) * 100000)
+                elif 'Crore' in value:
+                    value = value.replace('Crore', '').strip()
+                    value = str(float(value) * 10000000)
+                extracted_data[section][key] = value
+    return extracted_data
+
+@instrumented('extraction')
 def extract_info_with_gemini(ocr_text):
-    # Print OCR text for debugging
-    print("\nOCR Text for Analysis:")
-    print("=" * 50)
-    print(ocr_text)
-    print("=" * 50)
-
-    prompt = f"""
-    Extract the following information from the document OCR text. Return a JSON object with the extracted values.
-    If a value is not found, return null for that field.
-
-    OCR Text:
-    {ocr_text}
-
-    Required fields and extraction instructions:
-    {{
-        "Personal Information": {{
-            "Full Name": "extract the full name (look for patterns like 'Name:', 'Full Name:', or text before 'DOB:')",
-            "Date of Birth": "extract date of birth in DD/MM/YYYY format (look for 'DOB:', 'Date of Birth:', or similar patterns)",
-            "Age": "calculate age from date of birth",
-            "Gender": "extract gender (look for 'Gender:', 'Sex:', or M/F indicators)",
-            "Mobile Number": "extract the mobile number (look for 10-digit numbers, patterns like 'Mobile:', 'Phone:')",
-            "Father's Name": "extract father's name (look for 'Father:', 'Father's Name:', or similar patterns)",
-            "Caste": "extract caste information (look for 'Caste:', 'Category:', or similar terms)"
-        }},
-        "Aadhaar Details": {{
-            "Aadhaar Number": "extract the 12-digit Aadhaar number (look for 12 digits in groups of 4)",
-            "VID": "extract the 16-digit VID number (look for 16 digits after 'VID:')",
-            "Address": "extract the complete address (look for text after 'Address:', 'C/O:', or similar patterns)",
-            "Issue Date": "extract the issue date in DD/MM/YYYY format (look for 'Issue Date:', 'Date of Issue:', or similar patterns)"
-        }},
-        "PAN Details": {{
-            "PAN Number": "extract the Permanent Account Number (look for 'Permanent Account Number' or 'PAN' followed by 10 characters in format AAAAA9999A, or 5 letters followed by 4 numbers and 1 letter)"
-        }},
-        "Financial Information": {{
-            "Annual Income": "extract the annual income (look for patterns like 'Annual Income:', 'Income:', 'Rs.', 'INR', '₹', or numbers followed by 'per annum', 'p.a.', 'PA', 'Lakh', 'Lac', 'Crore')"
-        }}
-    }}
-
-    Instructions:
-    1. Look for patterns in the text carefully
-    2. Clean the extracted text by removing extra spaces and special characters
-    3. Format dates consistently in DD/MM/YYYY format
-    4. Format income as a number without currency symbols
-    5. Return a valid JSON object with all required fields
-    6. If a field cannot be found, set it to null
-    7. Calculate age from date of birth if available
-    8. For PAN number, look for:
-       - 10 characters in format AAAAA9999A
-       - Text after 'Permanent Account Number' or 'PAN'
-       - 5 letters followed by 4 numbers and 1 letter
-    9. For income, look for:
-       - Numbers followed by 'Lakh', 'Lac', 'Crore'
-       - Currency symbols (₹, Rs., INR)
-       - Terms like 'per annum', 'p.a.', 'PA'
-       - Convert all amounts to numbers (e.g., '5 Lakh' to '500000')
+    cache_key = extraction_cache.key(normalize_ocr_text(ocr_text).encode(), EXTRACTION_PROMPT_VERSION)
+    cached_data = extraction_cache.get(cache_key)
+    if cached_data is not None:
+        logger.info("Gemini extraction cache hit")
+        return copy.deepcopy(cached_data)
+
+    # Log OCR text for debugging
+    log_sampled("OCR Text for Analysis:\n%s", ocr_text)
+
+    # Strictly formatted ID fields come from local patterns; Gemini only sees what they missed
+    local_fields = extract_id_fields(ocr_text)
+    extracted_data = {
+        section: {key: local_fields.get((section, key)) for key in instructions}
+        for section, instructions in FIELD_INSTRUCTIONS.items()
+    }
+    missing_fields = {}
+    for section, instructions in FIELD_INSTRUCTIONS.items():
+        missing = {key: text for key, text in instructions.items() if (section, key) not in local_fields}
+        if missing:
+            missing_fields[section] = missing
+
+    if any((section, key) in REQUIRED_FIELDS
+           for section, instructions in missing_fields.items() for key in instructions):
+        try:
+            gemini_data = request_gemini_fields(ocr_text, missing_fields)
+        except Exception as e:
+            record_error('extraction')
+            logger.error("Gemini error: %s", e)
+            return extracted_data if local_fields else {}
+        for section, instructions in missing_fields.items():
+            for key in instructions:
+                extracted_data[section][key] = (gemini_data.get(section) or {}).get(key)
+    else:
+        logger.info("All required fields found locally, skipping Gemini")
+
+    log_sampled("Processed Extracted Data:\n%s", extracted_data)
+    extraction_cache.set(cache_key, copy.deepcopy(extracted_data))
+    return extracted_data
+
+def read_upload(file, user_id):
+    """Read an uploaded file into memory once and return its metadata and bytes"""
+    # Generate unique filename with timestamp
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    filename = secure_filename(file.filename)
+    unique_filename = f"{user_id}_{timestamp}_{filename}"
+    return {
+        'filename': unique_filename,
+        'original_name': filename,
+        'timestamp': timestamp,
+        'data': file.read()
+    }
+
+def retain_uploads(uploads):
+    """Write upload bytes to the upload folder when RETAIN_UPLOADS is set; returns paths keyed by filename"""
+    paths = {}
+    if not RETAIN_UPLOADS:
+        return paths
+    for upload in uploads:
+        file_path = os.path.join(UPLOAD_FOLDER, upload['filename'])
+        with open(file_path, 'wb') as f:
+            f.write(upload['data'])
+        paths[upload['filename']] = file_path
+    return paths
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def write_upload(document_data, face_records, session=None):
+    documents_collection.insert_one(document_data, session=session)
+    if face_records:
+        faces_collection.insert_many(face_records, ordered=False, session=session)
+
+def store_upload(document_data, face_records):
+    """Write a document and its face records in two round trips, atomically where MongoDB supports it
+
+    Without transactions a failed write is undone by deleting whatever part of the upload landed.
     """
+    if mongo_transactions.get():
+        with mongo_client.start_session() as session:
+            session.with_transaction(lambda s: write_upload(document_data, face_records, s))
+        return
 
     try:
-        response = model.generate_content(prompt)
-        print("\nGemini Response:")
-        print("=" * 50)
-        print(response.text)
-        print("=" * 50)
-        
-        # Parse the response text to extract the JSON
-        response_text = response.text
-        # Find the JSON object in the response
-        start_idx = response_text.find('{')
-        end_idx = response_text.rfind('}') + 1
-        if start_idx != -1 and end_idx != -1:
-            json_str = response_text[start_idx:end_idx]
-            extracted_data = json.loads(json_str)
-            
-            # Clean and standardize the data
-            for section in extracted_data:
-                for key, value in extracted_data[section].items():
-                    if isinstance(value, str):
-                        extracted_data[section][key] = value.strip()
-                    if value == "":
-                        extracted_data[section][key] = None
-                    
-                    # Format income if present
-                    if key == "Annual Income" and value:
-                        # Remove currency symbols and convert to standard format
-                        value = value.replace('₹', '').replace('Rs.', '').replace('INR', '').strip()
-                        # Remove 'per annum' or similar text
-                        value = value.split('per')[0].strip()
-                        # Convert Lakh/Lac to numbers
-                        if 'Lakh' in value or 'Lac' in value:
-                            value = value.replace('Lakh', '').replace('Lac', '').strip()
-                            value = str(float(value) * 100000)
-                        elif 'Crore' in value:
-                            value = value.replace('Crore', '').strip()
-                            value = str(float(value) * 10000000)
-                        extracted_data[section][key] = value
-            
-            print("\nProcessed Extracted Data:")
-            print("=" * 50)
-            print(json.dumps(extracted_data, indent=2))
-            print("=" * 50)
-            return extracted_data
-            
-        print("No valid JSON found in response")
-        return {}
+        write_upload(document_data, face_records)
+    except PyMongoError:
+        try:
+            faces_collection.delete_many({'document_id': document_data['_id']})
+            documents_collection.delete_one({'_id': document_data['_id']})
+        except PyMongoError as e:
+            logger.error("Cleanup of document %s failed: %s", document_data['_id'], e)
+        raise
+
+def index_faces(face_jpegs):
+    """Embed face crops into face_index and return their rows, None for crops that could not be embedded"""
+    rows = [None] * len(face_jpegs)
+    with track_stage('embedding'):
+        embedded = {}
+        for i, face_jpeg in enumerate(face_jpegs):
+            try:
+                embedded[i] = face_embedder.embed(face_jpeg)
+            except Exception as e:
+                logger.error("Face embedding error: %s", e)
+        try:
+            for i, row in zip(embedded, face_index.add_many(list(embedded.values()))):
+                rows[i] = row
+        except Exception as e:
+            logger.error("Face indexing error: %s", e)
+    return rows
+
+def prepare_upload(data):
+    with track_stage('prepare'):
+        return prepare_image(data, OCR_MAX_EDGE, DETECTION_IMAGE_SIZE)
+
+@instrumented('upload')
+def process_upload(user_id, uploads, on_progress=None):
+    """Run OCR, face detection and Gemini extraction over in-memory uploads and store the result"""
+    def report(stage, completed):
+        if on_progress:
+            on_progress(stage, completed, len(uploads))
+
+    processed_files = []
+    all_faces = []
+    face_records = []
+    combined_ocr_text = ""
+    document_id = ObjectId()
+
+    # Each file is decoded and normalized once on the detection pool. OCR of the normalized bytes
+    # is network-bound and runs on http_pool's event loop (or the I/O pool for blocking backends);
+    # inference is batched across files and requests by detection_batcher. Results are collected
+    # in upload order so combined_ocr_text stays deterministic.
+    prepare_futures = [detection_executor.submit(prepare_upload, f['data']) for f in uploads]
+    ocr_futures = []
+    detection_futures = []
+    for upload, prepare_future in zip(uploads, prepare_futures):
+        prepared = prepare_future.result()
+        ocr_futures.append(submit_ocr(prepared.ocr_data, cache_data=upload['data']))
+        detection_futures.append(detection_executor.submit(detect_faces, prepared))
+    report('processing', 0)
+
+    # Any failure before the document is stored gives back face blob references and embedding
+    # rows, along with retained upload files
+    retained_paths = {}
+    detected_faces = []
+    try:
+        for upload, ocr_future, detection_future in zip(uploads, ocr_futures, detection_futures):
+            filename = upload['original_name']
+            unique_filename = upload['filename']
+
+            try:
+                ocr_text = ocr_future.result()
+                faces = detection_future.result()
+            except Exception:
+                for future in ocr_futures + detection_futures:
+                    future.cancel()
+                raise
+
+            if ocr_text:
+                combined_ocr_text += f"\n\n=== Document: {filename} ===\n{ocr_text}\n"
+
+            detected_faces.extend((unique_filename, face_jpeg) for face_jpeg in faces)
+
+            processed_files.append({
+                'filename': unique_filename,
+                'original_name': filename,
+                'upload_time': datetime.now(),
+                'file_path': None
+            })
+            report('processing', len(processed_files))
+
+        # Identical crops share one blob; each occurrence takes a reference. References and
+        # embedding rows for all of the upload's faces take one Mongo round trip each.
+        face_jpegs = [face_jpeg for _, face_jpeg in detected_faces]
+        all_faces.extend(face_store.put_many(face_jpegs))
+        embedding_rows = index_faces(face_jpegs)
+        for (unique_filename, _), face_filename, embedding_row in zip(detected_faces, all_faces, embedding_rows):
+            # Face metadata is buffered and written together with the document
+            face_records.append({
+                'user_id': user_id,
+                'document_id': document_id,
+                'document_filename': unique_filename,
+                'face_filename': face_filename,
+                'timestamp': datetime.now(),
+                'face_path': face_store.path(face_filename),
+                'embedder': face_embedder.name,
+                'embedding_row': embedding_row
+            })
+
+        # Extract information using combined OCR text
+        report('extraction', len(processed_files))
+        extracted_info = extract_info_with_gemini(combined_ocr_text)
+
+        # Uploads only touch disk once processing has succeeded, and only when retention is on
+        retained_paths = retain_uploads(uploads)
+        for processed_file in processed_files:
+            processed_file['file_path'] = retained_paths.get(processed_file['filename'])
+
+        # Store document data in MongoDB
+        document_data = {
+            '_id': document_id,
+            'user_id': user_id,
+            'timestamp': datetime.now(),
+            'files': processed_files,
+            'faces': all_faces,
+            'ocr_text': combined_ocr_text,
+            'extracted_info': extracted_info
+        }
+
+        with track_stage('mongo_insert'):
+            store_upload(document_data, face_records)
+    except Exception:
+        remove_files(retained_paths.values())
+        for face_filename in all_faces:
+            face_store.release(face_filename)
+        face_index.remove([record['embedding_row'] for record in face_records])
+        raise
+
+    return {
+        'status': 'success',
+        'document_id': str(document_id),
+        'files': processed_files,
+        'faces': all_faces,
+        'extractedInfo': extracted_info,
+        'ocrText': combined_ocr_text
+    }
+
+def update_job(job_id, **fields):
+    fields['updated_at'] = datetime.now()
+    jobs_collection.update_one({'_id': job_id}, {'$set': fields})
+
+def run_upload_job(job_id, user_id, uploads):
+    """Background worker entry point for an asynchronous upload"""
+    def on_progress(stage, completed, total):
+        update_job(job_id, stage=stage, progress={'completed': completed, 'total': total})
+
+    update_job(job_id, status='running')
+    try:
+        result = process_upload(user_id, uploads, on_progress)
+        update_job(job_id, status='completed', stage='done',
+                   progress={'completed': len(uploads), 'total': len(uploads)},
+                   result=result)
     except Exception as e:
-        print(f"Gemini error: {e}")
-        return {}
+        logger.exception("Error processing job %s: %s", job_id, e)
+        update_job(job_id, status='failed', error=str(e))
+
+def record_shed_job(job_id, future):
+    """Mark a queued job failed when higher-priority work displaced it from the queue"""
+    if not future.cancelled() and isinstance(future.exception(), QueueFullError):
+        error = future.exception()
+        update_job(job_id, status='failed', error=str(error), retry_after=math.ceil(error.retry_after))
+
+def admission_delay(file_count, priority):
+    """Seconds an upload would wait for a worker and for upstream quota, if that exceeds ADMISSION_MAX_WAIT"""
+    delay = max(
+        upload_scheduler.wait_estimate(priority),
+        azure_quota.delay_for(file_count) if OCR_BACKEND in ('azure', 'routed') else 0.0,
+        gemini_quota.delay_for()
+    )
+    return delay if delay > ADMISSION_MAX_WAIT else None
+
+def shed_response(retry_after):
+    retry_after = math.ceil(retry_after)
+    response = jsonify({
+        'error': 'Service busy',
+        'message': 'Too much work is queued. Please try again later.',
+        'retry_after': retry_after
+    })
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def serialize_job(job):
+    """Convert a job record into a JSON-serializable dict"""
+    job['job_id'] = job.pop('_id')
+    for key in ('created_at', 'updated_at'):
+        if job.get(key):
+            job[key] = job[key].isoformat()
+    result = job.get('result')
+    if result:
+        for file in result['files']:
+            file['upload_time'] = file['upload_time'].isoformat()
+    return job
 
 @app.route('/api/upload', methods=['POST'])
 @limiter.limit("5 per minute")
@@ -249,121 +863,182 @@ def upload_file():
     
     if not files or all(file.filename == '' for file in files):
         return jsonify({'error': 'No selected files'}), 400
-    
+
+    # Clients opt in to job-submission mode with ?async=true or an "async" form field
+    async_mode = (request.args.get('async') or request.form.get('async', '')).lower() in ('1', 'true', 'yes')
+    # Priority is decided here, not taken from the client, so uploads cannot jump the queue
+    recheck_id = request.args.get('recheck') or request.form.get('recheck')
+    priority = UPLOAD_PRIORITIES['upload']
+    if recheck_id:
+        try:
+            rechecked = documents_collection.find_one({'_id': ObjectId(recheck_id), 'user_id': user_id}, {'_id': 1})
+        except InvalidId:
+            return jsonify({'error': 'Invalid document ID'}), 400
+        if rechecked is None:
+            return jsonify({'error': 'Document not found'}), 404
+        priority = UPLOAD_PRIORITIES['recheck']
+
+    # Shed work that could not start within ADMISSION_MAX_WAIT before reading any upload
+    retry_after = admission_delay(len(files), priority)
+    if retry_after is not None:
+        return shed_response(retry_after)
+
+    uploads = []
     try:
-        # Create user-specific collection
-        user_collection = db[f'user_{user_id}_documents']
-        faces_collection = db[f'user_{user_id}_faces']
-        
-        processed_files = []
-        all_faces = []
-        combined_ocr_text = ""
-        
         for file in files:
             if file and allowed_file(file.filename):
-                # Generate unique filename with timestamp
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-                filename = secure_filename(file.filename)
-                unique_filename = f"{user_id}_{timestamp}_{filename}"
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-                file.save(file_path)
-                
-                # Process OCR for each file
-                ocr_text = process_ocr(file_path)
-                if ocr_text:
-                    combined_ocr_text += f"\n\n=== Document: {filename} ===\n{ocr_text}\n"
-                
-                # Detect faces in each file
-                faces = detect_faces(file_path)
-                
-                # Store faces in MongoDB
-                for face_idx, face_img in enumerate(faces):
-                    face_filename = f"{user_id}_{timestamp}_face_{face_idx}.jpg"
-                    face_path = os.path.join(FACES_FOLDER, face_filename)
-                    cv2.imwrite(face_path, face_img)
-                    
-                    # Store face metadata in MongoDB
-                    face_data = {
-                        'user_id': user_id,
-                        'document_filename': unique_filename,
-                        'face_filename': face_filename,
-                        'timestamp': datetime.now(),
-                        'face_path': face_path
-                    }
-                    faces_collection.insert_one(face_data)
-                    all_faces.append(face_filename)
-                
-                processed_files.append({
-                    'filename': unique_filename,
-                    'original_name': filename,
-                    'upload_time': datetime.now(),
-                    'file_path': file_path
-                })
-        
-        # Extract information using combined OCR text
-        extracted_info = extract_info_with_gemini(combined_ocr_text)
-        
-        # Store document data in MongoDB
-        document_data = {
-            'user_id': user_id,
-            'timestamp': datetime.now(),
-            'files': processed_files,
-            'faces': all_faces,
-            'ocr_text': combined_ocr_text,
-            'extracted_info': extracted_info
-        }
-        
-        result = user_collection.insert_one(document_data)
-        
-        return jsonify({
-            'status': 'success',
-            'document_id': str(result.inserted_id),
-            'files': processed_files,
-            'faces': all_faces,
-            'extractedInfo': extracted_info,
-            'ocrText': combined_ocr_text
-        })
-        
-    except Exception as e:
-        print(f"Error processing files: {e}")
-        # Clean up uploaded files in case of error
-        for processed_file in processed_files:
+                uploads.append(read_upload(file, user_id))
+
+        if async_mode:
+            job_id = uuid.uuid4().hex
+            now = datetime.now()
+            jobs_collection.insert_one({
+                '_id': job_id,
+                'user_id': user_id,
+                'status': 'queued',
+                'stage': 'queued',
+                'progress': {'completed': 0, 'total': len(uploads)},
+                'created_at': now,
+                'updated_at': now
+            })
             try:
-                os.remove(processed_file['file_path'])
-            except:
-                pass
+                future = upload_scheduler.submit(priority, run_upload_job, job_id, user_id, uploads)
+            except QueueFullError as e:
+                update_job(job_id, status='failed', error=str(e), retry_after=math.ceil(e.retry_after))
+                return shed_response(e.retry_after)
+            future.add_done_callback(lambda f: record_shed_job(job_id, f))
+            return jsonify({
+                'status': 'queued',
+                'job_id': job_id,
+                'status_url': f'/api/jobs/{job_id}',
+                'events_url': f'/api/jobs/{job_id}/events'
+            }), 202
+
+        return jsonify(upload_scheduler.submit(priority, process_upload, user_id, uploads).result())
+
+    except QueueFullError as e:
+        return shed_response(e.retry_after)
+    except Exception as e:
+        logger.exception("Error processing files: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@limiter.exempt
+def get_job(job_id):
+    try:
+        job = jobs_collection.find_one({'_id': job_id})
+        if job:
+            return jsonify(serialize_job(job))
+        return jsonify({'error': 'Job not found'}), 404
+    except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+@limiter.exempt
+def stream_job(job_id):
+    """Stream job progress as server-sent events until the job finishes"""
+    if not jobs_collection.find_one({'_id': job_id}, {'_id': 1}):
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        last_update = None
+        while True:
+            job = jobs_collection.find_one({'_id': job_id})
+            if job is None:
+                break
+            if job['updated_at'] != last_update:
+                last_update = job['updated_at']
+                yield f"data: {json.dumps(serialize_job(job))}\n\n"
+            if job['status'] in ('completed', 'failed'):
+                break
+            time.sleep(JOB_STREAM_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+def serialize_document(document):
+    """Convert ObjectId and datetime fields of a document record to strings"""
+    document['_id'] = str(document['_id'])
+    document['timestamp'] = document['timestamp'].isoformat()
+    for file in document['files']:
+        file['upload_time'] = file['upload_time'].isoformat()
+    return document
+
+def document_cursor(document, sort_key):
+    """Build the opaque keyset cursor that resumes a listing after this document"""
+    if sort_key == '_id':
+        return str(document['_id'])
+    return f"{document['timestamp'].isoformat()}_{document['_id']}"
+
+def documents_after(cursor, sort_key):
+    """Translate a keyset cursor into a query filter for the next page"""
+    if sort_key == '_id':
+        return {'_id': {'$gt': ObjectId(cursor)}}
+    timestamp, document_id = cursor.rsplit('_', 1)
+    timestamp = datetime.fromisoformat(timestamp)
+    # Ties on timestamp are broken by _id so no document is skipped or repeated
+    return {'$or': [
+        {'timestamp': {'$gt': timestamp}},
+        {'timestamp': timestamp, '_id': {'$gt': ObjectId(document_id)}}
+    ]}
+
 @app.route('/api/documents/<user_id>', methods=['GET'])
 def get_user_documents(user_id):
+    """List a user's documents a page at a time
+
+    Query parameters: limit, after (the X-Next-After cursor of the previous page),
+    sort (timestamp or _id), include_ocr_text (true to return the OCR blob) and
+    format (json, or ndjson to stream documents as they come off the cursor; a full ndjson
+    page ends with a {"next_after": cursor} line, since headers are sent before the stream).
+    """
+    sort_key = request.args.get('sort', 'timestamp')
+    response_format = request.args.get('format', 'json')
+    if sort_key not in ('timestamp', '_id') or response_format not in ('json', 'ndjson'):
+        return jsonify({'error': 'Invalid sort or format'}), 400
     try:
-        user_collection = db[f'user_{user_id}_documents']
-        documents = list(user_collection.find())
-        
-        # Convert ObjectId and datetime to string for JSON serialization
-        for doc in documents:
-            doc['_id'] = str(doc['_id'])
-            doc['timestamp'] = doc['timestamp'].isoformat()
-            for file in doc['files']:
-                file['upload_time'] = file['upload_time'].isoformat()
-        
-        return jsonify(documents)
+        limit = max(1, min(int(request.args.get('limit', DOCUMENTS_PAGE_SIZE)), DOCUMENTS_MAX_PAGE_SIZE))
+        query = {'user_id': user_id}
+        after = request.args.get('after')
+        if after:
+            query.update(documents_after(after, sort_key))
+    except (ValueError, InvalidId):
+        return jsonify({'error': 'Invalid limit or cursor'}), 400
+
+    projection = None
+    if request.args.get('include_ocr_text', '').lower() not in ('1', 'true', 'yes'):
+        projection = {'ocr_text': 0}
+    sort = [('_id', ASCENDING)] if sort_key == '_id' else [('timestamp', ASCENDING), ('_id', ASCENDING)]
+
+    try:
+        cursor = documents_collection.find(query, projection).sort(sort).limit(limit)
+
+        if response_format == 'ndjson':
+            def generate():
+                count = 0
+                for document in cursor:
+                    count += 1
+                    next_after = document_cursor(document, sort_key)
+                    yield json.dumps(serialize_document(document)) + '\n'
+                # A full page ends with a {"next_after": cursor} line in place of the X-Next-After header
+                if count == limit:
+                    yield json.dumps({'next_after': next_after}) + '\n'
+            return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+        documents = list(cursor)
+        headers = {}
+        if len(documents) == limit:
+            headers['X-Next-After'] = document_cursor(documents[-1], sort_key)
+        return jsonify([serialize_document(document) for document in documents]), 200, headers
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/api/documents/<user_id>/<document_id>', methods=['GET'])
 def get_document(user_id, document_id):
     try:
-        user_collection = db[f'user_{user_id}_documents']
-        document = user_collection.find_one({'_id': ObjectId(document_id)})
+        document = documents_collection.find_one({'_id': ObjectId(document_id), 'user_id': user_id})
         
         if document:
-            # Convert ObjectId and datetime to string
-            document['_id'] = str(document['_id'])
-            document['timestamp'] = document['timestamp'].isoformat()
-            for file in document['files']:
-                file['upload_time'] = file['upload_time'].isoformat()
-            return jsonify(document)
+            return jsonify(serialize_document(document))
             
         return jsonify({'error': 'Document not found'}), 404
     except Exception as e:
@@ -372,30 +1047,36 @@ def get_document(user_id, document_id):
 @app.route('/api/documents/<user_id>/<document_id>', methods=['DELETE'])
 def delete_document(user_id, document_id):
     try:
-        user_collection = db[f'user_{user_id}_documents']
-        faces_collection = db[f'user_{user_id}_faces']
-        
-        # Get document details
-        document = user_collection.find_one({'_id': ObjectId(document_id)})
+        # Delete the record first so only one of two concurrent deletes goes on to release its faces
+        document = documents_collection.find_one_and_delete({'_id': ObjectId(document_id), 'user_id': user_id})
         
         if document:
             # Delete associated files
             for file in document['files']:
                 file_path = file['file_path']
-                if os.path.exists(file_path):
+                if file_path and os.path.exists(file_path):
                     os.remove(file_path)
             
-            # Delete associated faces
+            # Release associated faces; blobs shared with other documents stay on disk
             for face in document['faces']:
-                # Delete face file
-                face_path = os.path.join(FACES_FOLDER, face)
-                if os.path.exists(face_path):
-                    os.remove(face_path)
-                # Delete face record
-                faces_collection.delete_many({'face_filename': face})
-            
-            # Delete document record
-            user_collection.delete_one({'_id': ObjectId(document_id)})
+                face_store.release(face)
+            # Delete face records and drop their embeddings from the similarity index
+            # Filenames only have one-second precision, so they are matched only for records
+            # written before faces carried their document_id
+            face_filter = {
+                'user_id': user_id,
+                '$or': [
+                    {'document_id': document['_id']},
+                    {'document_id': {'$exists': False},
+                     'document_filename': {'$in': [file['filename'] for file in document['files']]}}
+                ]
+            }
+            # Rows of faces embedded by a previous FACE_EMBEDDING_MODEL belong to that embedder's matrix
+            face_rows = [face.get('embedding_row')
+                         for face in faces_collection.find(dict(face_filter, embedder=face_embedder.name),
+                                                           {'embedding_row': 1})]
+            face_index.remove(face_rows)
+            faces_collection.delete_many(face_filter)
             
             return jsonify({'status': 'success', 'message': 'Document and associated data deleted successfully'})
         
@@ -403,15 +1084,62 @@ def delete_document(user_id, document_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/ready', methods=['GET'])
+@limiter.exempt
+def readiness():
+    """Report which models and clients are loaded; 503 until those the warmup mode loads up front are"""
+    status = {component.name: component.status() for component in components}
+    ready = all(component.loaded for component in ready_components)
+    return jsonify({'ready': ready, 'components': status}), 200 if ready else 503
+
+@app.route('/api/cache/stats', methods=['GET'])
+@limiter.exempt
+def get_cache_stats():
+    return jsonify({'ocr': ocr_cache.stats(), 'extraction': extraction_cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+@limiter.exempt
+def prometheus_metrics():
+    """Prometheus scrape endpoint: per-stage latency histograms, in-flight gauges and error counters"""
+    return Response(generate_latest(scrape_registry()), content_type=CONTENT_TYPE_LATEST)
+
+def send_face(filename):
+    """Send a face crop, or its thumbnail when requested with ?variant=thumb
+
+    Crops never change once written, so they are served as immutable assets with a
+    content ETag. Conditional requests get 304 without the file being streamed, and
+    with FACES_ACCEL_REDIRECT set the bytes are left to the front proxy entirely.
+    """
+    thumbnail = request.args.get('variant') == 'thumb'
+    face_path = face_store.path(filename, thumbnail=thumbnail)
+    if face_path is None:
+        return jsonify({'error': 'Invalid filename'}), 400
+    if not os.path.exists(face_path):
+        return jsonify({'error': 'Face image not found'}), 404
+
+    etag = face_store.etag(filename, thumbnail)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+    elif FACES_ACCEL_REDIRECT:
+        response = Response(mimetype='image/jpeg')
+        response.set_etag(etag)
+        relative_path = os.path.relpath(face_path, FACES_FOLDER).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{FACES_ACCEL_REDIRECT.rstrip('/')}/{relative_path}"
+    else:
+        response = send_file(face_path, mimetype='image/jpeg', etag=etag, conditional=True,
+                             max_age=FACE_CACHE_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={FACE_CACHE_MAX_AGE}, immutable'
+    return response
+
 @app.route('/faces/<filename>')
 def serve_face(filename):
-    return send_from_directory(FACES_FOLDER, filename)
+    return send_face(filename)
 
 @app.route('/api/faces/<user_id>', methods=['GET'])
 def get_user_faces(user_id):
     try:
-        faces_collection = db[f'user_{user_id}_faces']
-        faces = list(faces_collection.find())
+        faces = list(faces_collection.find({'user_id': user_id}).sort('timestamp', ASCENDING))
         
         # Convert ObjectId and datetime to string
         for face in faces:
@@ -422,25 +1150,53 @@ def get_user_faces(user_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/faces/<face_id>/similar', methods=['GET'])
+@limiter.exempt
+def get_similar_faces(face_id):
+    """Top-k stored faces most similar to a face record, optionally only those of other users"""
+    try:
+        face = faces_collection.find_one({'_id': ObjectId(face_id)})
+    except InvalidId:
+        return jsonify({'error': 'Invalid face ID'}), 400
+    if face is None:
+        return jsonify({'error': 'Face not found'}), 404
+    if face.get('embedding_row') is None or face.get('embedder') != face_embedder.name:
+        return jsonify({'error': f'Face has no {face_embedder.name} embedding'}), 409
+
+    k = max(1, min(request.args.get('k', 10, type=int), FACE_SIMILAR_MAX_K))
+    other_users = request.args.get('other_users', '').lower() in ('1', 'true', 'yes')
+    row = face['embedding_row']
+    vector = face_index.vector(row)
+    # Over-fetch when filtering by user so k results usually survive the filter
+    matches = face_index.search(vector, k * 4 if other_users else k, exclude=[row])
+    scores = dict(matches)
+    records = {
+        record['embedding_row']: record
+        for record in faces_collection.find({'embedder': face_embedder.name, 'embedding_row': {'$in': list(scores)}})
+    }
+
+    results = []
+    for match_row, score in matches:
+        record = records.get(match_row)
+        if record is None or (other_users and record['user_id'] == face['user_id']):
+            continue
+        results.append({
+            'face_id': str(record['_id']),
+            'user_id': record['user_id'],
+            'face_filename': record['face_filename'],
+            'document_filename': record['document_filename'],
+            'similarity': score
+        })
+    return jsonify({'face_id': face_id, 'embedder': face_embedder.name, 'matches': results[:k]})
+
 @app.route('/api/faces/<filename>')
 def get_face_image(filename):
     try:
-        # Ensure the filename is safe
-        if '..' in filename or filename.startswith('/'):
-            return jsonify({'error': 'Invalid filename'}), 400
-            
-        # Get the face image path
-        face_path = os.path.join(app.config['UPLOAD_FOLDER'], 'faces', filename)
-        
-        # Check if file exists
-        if not os.path.exists(face_path):
-            return jsonify({'error': 'Face image not found'}), 404
-            
-        return send_file(face_path, mimetype='image/jpeg')
+        return send_face(filename)
     except Exception as e:
-        print(f"Error serving face image: {str(e)}")
+        logger.error("Error serving face image: %s", e)
         return jsonify({'error': 'Failed to serve face image'}), 500
 
 if __name__ == '__main__':
-    print("Starting server...")
+    logger.info("Starting server...")
     app.run(debug=True, port=5000)
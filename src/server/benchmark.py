@@ -0,0 +1,223 @@
+"""End-to-end benchmark for /api/upload with local stand-ins for the external services.
+
+The server runs in-process on a local port with:
+- Azure Read replaced by FixtureBackend: recorded text from --fixtures when present,
+  otherwise a canned Aadhaar/PAN text, after --ocr-latency seconds
+- Gemini replaced by a fake model that answers after --gemini-latency seconds
+- MongoDB replaced by mongomock
+- YOLO, image preprocessing and everything else running for real
+
+Images from --corpus are replayed as multipart uploads from --concurrency client threads.
+The report gives p50/p95/p99 latency per stage and for whole requests, plus requests/second.
+
+    pip install mongomock
+    python benchmark.py --corpus ../../uploads --requests 100 --concurrency 8
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf')
+
+SAMPLE_OCR_TEXT = """GOVERNMENT OF INDIA
+Ramesh Kumar
+DOB: 14/08/1990
+MALE
+1234 5678 9012
+VID : 9123 4567 8901 2345
+INCOME TAX DEPARTMENT
+ABCDE1234F
+"""
+
+
+class FakeGeminiResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """Answers every prompt with null for each requested field after a fixed delay"""
+
+    def __init__(self, fields, latency):
+        self.fields = fields
+        self.latency = latency
+
+    def generate_content(self, prompt, **kwargs):
+        time.sleep(self.latency)
+        answer = {section: {key: None for key in keys} for section, keys in self.fields.items()}
+        return FakeGeminiResponse(json.dumps(answer))
+
+
+class StageTimer:
+    """Collects wall-clock durations per stage from wrapped pipeline functions"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start)
+        return timed
+
+
+def load_app(args, timer):
+    """Import the server with its external services replaced by local stand-ins"""
+    import mongomock
+    import pymongo
+
+    pymongo.MongoClient = mongomock.MongoClient
+    os.environ.setdefault('WARMUP_MODE', 'lazy')
+    os.environ.setdefault('MONGO_TRANSACTIONS', 'false')
+    # The stand-ins have no quotas; only the simulated latencies should bound throughput
+    os.environ.setdefault('AZURE_READ_RATE', '1000000')
+    os.environ.setdefault('GEMINI_RATE', '1000000')
+    os.environ.setdefault('ADMISSION_MAX_WAIT', 'inf')
+    if not args.with_caches:
+        os.environ['OCR_CACHE_BACKEND'] = 'none'
+        os.environ['EXTRACTION_CACHE_BACKEND'] = 'none'
+    sys.path.insert(0, SERVER_DIR)
+
+    import app as server
+    from lazy import LazyResource
+    from ocr_backends import FixtureBackend
+
+    server.limiter.enabled = False
+    server.ocr_backend = FixtureBackend(args.fixtures, args.ocr_latency, default_text=SAMPLE_OCR_TEXT)
+    server.model = LazyResource('gemini', lambda: FakeGeminiModel(server.FIELD_INSTRUCTIONS, args.gemini_latency))
+    for stage, name in (('prepare', 'prepare_image'), ('ocr', 'process_ocr'),
+                        ('detection', 'detect_faces'), ('extraction', 'extract_info_with_gemini')):
+        setattr(server, name, timer.wrap(stage, getattr(server, name)))
+
+    # Load the model up front so the first requests don't carry it
+    server.yolo_model.get()
+    return server
+
+
+def start_server(server):
+    from werkzeug.serving import make_server
+
+    http_server = make_server('127.0.0.1', 0, server.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    return http_server
+
+
+def multipart_body(files, fields):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for path in files:
+        with open(path, 'rb') as f:
+            data = f.read()
+        header = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; '
+                  f'filename="{os.path.basename(path)}"\r\nContent-Type: application/octet-stream\r\n\r\n')
+        parts.append(header.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def upload(url, files, timer):
+    body, content_type = multipart_body(files, {'userId': f'bench_{uuid.uuid4().hex[:8]}'})
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': content_type}, method='POST')
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            ok = response.status == 200
+    except urllib.error.HTTPError as e:
+        print(f"Upload failed with {e.code}: {e.read()[:200]!r}")
+        ok = False
+    timer.record('request', time.perf_counter() - start)
+    return ok
+
+
+def percentiles(samples):
+    if len(samples) < 2:
+        value = samples[0] if samples else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(samples, n=100, method='inclusive')
+    return cuts[49], cuts[94], cuts[98]
+
+
+def report(timer, elapsed, completed, failed):
+    print(f"\n{'stage':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    results = {}
+    for stage in ('prepare', 'ocr', 'detection', 'extraction', 'request'):
+        samples = timer.samples.get(stage, [])
+        p50, p95, p99 = percentiles(samples)
+        results[stage] = {'count': len(samples), 'p50': p50, 'p95': p95, 'p99': p99}
+        print(f"{stage:<12}{len(samples):>8}{p50 * 1000:>10.1f}{p95 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+    results['throughput'] = completed / elapsed if elapsed else 0.0
+    print(f"\n{completed} requests ({failed} failed) in {elapsed:.2f}s: {results['throughput']:.2f} requests/s")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark /api/upload with local service stand-ins")
+    parser.add_argument('--corpus', default=os.path.join(SERVER_DIR, '..', '..', 'uploads'),
+                        help="directory of sample Aadhaar/PAN/ration images")
+    parser.add_argument('--fixtures', default=None, help="recorded OCR text directory (<sha256>.txt)")
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--files-per-request', type=int, default=3)
+    parser.add_argument('--ocr-latency', type=float, default=1.0, help="simulated Azure Read seconds per document")
+    parser.add_argument('--gemini-latency', type=float, default=1.5, help="simulated Gemini seconds per call")
+    parser.add_argument('--with-caches', action='store_true', help="keep the OCR and extraction caches enabled")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    corpus = sorted(
+        os.path.join(os.path.abspath(args.corpus), name) for name in os.listdir(args.corpus)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    if not corpus:
+        parser.error(f"No images found in {args.corpus}")
+
+    # Keep the faces/ and uploads/ folders the server creates out of the source tree
+    workdir = tempfile.mkdtemp(prefix='equichain-bench-')
+    args.fixtures = os.path.abspath(args.fixtures) if args.fixtures else os.path.join(workdir, 'fixtures')
+    args.json = os.path.abspath(args.json) if args.json else None
+    os.chdir(workdir)
+
+    timer = StageTimer()
+    server = load_app(args, timer)
+    http_server = start_server(server)
+    url = f"http://127.0.0.1:{http_server.server_port}/api/upload"
+
+    files = itertools.cycle(corpus)
+    batches = [[next(files) for _ in range(args.files_per_request)] for _ in range(args.requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as clients:
+        outcomes = list(clients.map(lambda batch: upload(url, batch, timer), batches))
+    elapsed = time.perf_counter() - start
+    http_server.shutdown()
+
+    results = report(timer, elapsed, len(outcomes), outcomes.count(False))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
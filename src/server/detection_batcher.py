@@ -0,0 +1,59 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DetectionBatcher:
+    """Collects images from concurrent callers and runs them through the model as one batch
+
+    A batch is dispatched once it holds max_batch_size images or max_wait seconds after its
+    first image arrived, whichever comes first. All inference happens on the batcher thread,
+    which is started on first submit so a batcher created before a fork works in the child.
+    """
+
+    def __init__(self, predict, max_batch_size=8, max_wait=0.05):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, img):
+        """Queue one image and return a Future resolving to its per-image result"""
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._run, name='detection-batcher', daemon=True)
+                    self.thread.start()
+        future = Future()
+        self.pending.put((img, future))
+        return future
+
+    def _collect(self):
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = [(img, future) for img, future in self._collect() if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.predict([img for img, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
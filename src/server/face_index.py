@@ -0,0 +1,252 @@
+import fcntl
+import os
+import threading
+import time
+from array import array
+
+import numpy as np
+from pymongo import ReturnDocument
+
+from lazy import LazyModule
+
+cv2 = LazyModule('cv2')
+
+# Row states in states.u8
+EMPTY, LIVE, DELETED = 0, 1, 2
+
+
+class PixelEmbedder:
+    """Downscaled, contrast-equalized grayscale pixels
+
+    Finds re-uploads and rescans of the same photo, not the same person in different photos.
+    """
+
+    name = 'pixels'
+    dim = 256
+
+    def embed(self, jpeg):
+        img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_GRAYSCALE)
+        img = cv2.equalizeHist(cv2.resize(img, (16, 16), interpolation=cv2.INTER_AREA))
+        vector = img.astype(np.float32).ravel()
+        return vector - vector.mean()
+
+
+class SFaceEmbedder:
+    """OpenCV's SFace recognition model (face_recognition_sface_2021dec.onnx)
+
+    SFace expects aligned 112x112 face crops, but detect_faces yields unaligned YOLO person
+    boxes with no landmarks, resized here as they are. Near-identical crops match reliably;
+    the same person across different photos only does when the boxes happen to be tight and frontal.
+    """
+
+    name = 'sface'
+    dim = 128
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.local = threading.local()
+
+    def embed(self, jpeg):
+        # FaceRecognizerSF is not thread-safe, so each thread loads its own
+        recognizer = getattr(self.local, 'recognizer', None)
+        if recognizer is None:
+            recognizer = self.local.recognizer = cv2.FaceRecognizerSF.create(self.model_path, '')
+        img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        return recognizer.feature(cv2.resize(img, (112, 112), interpolation=cv2.INTER_AREA)).ravel()
+
+
+def create_face_embedder(model_path=None):
+    return SFaceEmbedder(model_path) if model_path else PixelEmbedder()
+
+
+def _unit(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class FaceIndex:
+    """Face embeddings in a memory-mapped matrix with an inverted-file nearest-neighbour index
+
+    Row i of <directory>/vectors.f32 is the unit-length embedding of one face record, and byte i
+    of states.u8 says whether it is live. Both files are shared by every process on the host and
+    rows are handed out by a Mongo counter, so any process can insert. Each process keeps its own
+    inverted lists and catches up on rows written elsewhere before searching.
+
+    Once train_size rows exist, spherical k-means centroids are trained once and saved. A search
+    then scores only the rows in the nprobe lists nearest the query; before that it scans every
+    row. Deleted rows stay in the lists and are skipped.
+
+    A row still empty grace seconds after it was first seen is passed over: its writer died,
+    or another host wrote it into that host's files. A row written after being passed over
+    is only listed after a restart.
+    """
+
+    def __init__(self, directory, dim, counters, name='face_index', lists=256, nprobe=8, train_size=8192,
+                 grace=60.0):
+        self.directory = directory
+        self.dim = dim
+        self.counters = counters
+        self.name = name
+        self.lists = lists
+        self.nprobe = nprobe
+        self.train_size = train_size
+        self.grace = grace
+        self.vectors_path = os.path.join(directory, 'vectors.f32')
+        self.states_path = os.path.join(directory, 'states.u8')
+        self.centroids_path = os.path.join(directory, 'centroids.npy')
+        self.vectors = None
+        self.states = None
+        self.capacity = 0
+        self.centroids = None
+        self.inverted = None
+        self.indexed = 0
+        self.empty_since = {}
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _map(self, rows):
+        """Map the files, growing them first if they hold fewer than rows rows"""
+        if rows <= self.capacity:
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            # Growth is serialized across processes so a smaller truncate never follows a larger one
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            row_bytes = self.dim * 4
+            capacity = os.path.getsize(self.vectors_path) // row_bytes if os.path.exists(self.vectors_path) else 0
+            if capacity < rows:
+                capacity = max(rows, capacity * 2, 1024)
+                for path, width in ((self.vectors_path, row_bytes), (self.states_path, 1)):
+                    with open(path, 'ab') as f:
+                        f.truncate(capacity * width)
+        self.vectors = np.memmap(self.vectors_path, np.float32, 'r+', shape=(capacity, self.dim))
+        self.states = np.memmap(self.states_path, np.uint8, 'r+', shape=(capacity,))
+        self.capacity = capacity
+
+    def _row_count(self):
+        record = self.counters.find_one({'_id': self.name})
+        return record['rows'] if record else 0
+
+    def add(self, vector):
+        """Store an embedding and return its row"""
+        return self.add_many([vector])[0]
+
+    def add_many(self, vectors):
+        """Store embeddings in consecutive rows allocated with one counter update; returns the rows"""
+        if not len(vectors):
+            return []
+        count = len(vectors)
+        record = self.counters.find_one_and_update(
+            {'_id': self.name}, {'$inc': {'rows': count}}, upsert=True, return_document=ReturnDocument.AFTER
+        )
+        first = record['rows'] - count
+        with self.lock:
+            self._map(first + count)
+            self.vectors[first:first + count] = _unit(vectors)
+            self.states[first:first + count] = LIVE
+        return list(range(first, first + count))
+
+    def vector(self, row):
+        with self.lock:
+            self._map(row + 1)
+            return np.array(self.vectors[row])
+
+    def remove(self, rows):
+        rows = [row for row in rows if row is not None]
+        if not rows:
+            return
+        with self.lock:
+            self._map(max(rows) + 1)
+            self.states[rows] = DELETED
+
+    def _train(self, rows):
+        """Spherical k-means over a sample of live rows"""
+        live = np.flatnonzero(self.states[:rows] == LIVE)
+        rng = np.random.default_rng(0)
+        sample = _unit(self.vectors[np.sort(rng.choice(live, min(len(live), self.lists * 64), replace=False))])
+        centroids = sample[rng.choice(len(sample), self.lists, replace=False)]
+        for _ in range(10):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            for list_id in range(self.lists):
+                members = sample[labels == list_id]
+                if len(members):
+                    centroids[list_id] = members.sum(axis=0)
+            centroids = _unit(centroids)
+        return centroids
+
+    def _load_centroids(self, rows):
+        if not os.path.exists(self.centroids_path):
+            if np.count_nonzero(self.states[:rows] == LIVE) < max(self.train_size, self.lists):
+                return
+            # The first process to link its file wins; the others load the winner's centroids
+            tmp_path = f"{self.centroids_path}.{os.getpid()}.tmp.npy"
+            np.save(tmp_path, self._train(rows))
+            try:
+                os.link(tmp_path, self.centroids_path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(tmp_path)
+        self.centroids = np.load(self.centroids_path)
+        self.inverted = [array('i') for _ in range(len(self.centroids))]
+        self.indexed = 0
+
+    def _catch_up(self):
+        """Assign rows written since the last search to inverted lists; returns the row count"""
+        rows = self._row_count()
+        if rows == 0:
+            return 0
+        self._map(rows)
+        if self.centroids is None:
+            self._load_centroids(rows)
+            if self.centroids is None:
+                return rows
+        # Rows are allocated before they are written, so stop at the first empty row that may
+        # still be written and pass over those empty for longer than the grace period
+        now = time.monotonic()
+        end = rows
+        empty = [int(row) for row in np.flatnonzero(self.states[self.indexed:rows] == EMPTY) + self.indexed]
+        for row in empty:
+            self.empty_since.setdefault(row, now)
+        for row in empty:
+            if now - self.empty_since[row] < self.grace:
+                end = row
+                break
+        self.empty_since = {row: since for row, since in self.empty_since.items() if row >= end}
+
+        for start in range(self.indexed, end, 65536):
+            stop = min(start + 65536, end)
+            written = np.flatnonzero(self.states[start:stop] != EMPTY)
+            labels = np.argmax(self.vectors[start:stop][written] @ self.centroids.T, axis=1)
+            order = np.argsort(labels, kind='stable')
+            bounds = np.searchsorted(labels[order], np.arange(len(self.centroids) + 1))
+            for list_id in range(len(self.centroids)):
+                members = written[order[bounds[list_id]:bounds[list_id + 1]]] + start
+                self.inverted[list_id].frombytes(members.astype(np.int32).tobytes())
+        self.indexed = end
+        return rows
+
+    def search(self, vector, k=10, exclude=()):
+        """Return up to k (row, cosine similarity) pairs, most similar first"""
+        query = _unit(vector)
+        with self.lock:
+            rows = self._catch_up()
+            if rows == 0:
+                return []
+            vectors, states = self.vectors, self.states
+            if self.centroids is None:
+                candidates = np.arange(rows)
+            else:
+                closeness = self.centroids @ query
+                probe = np.argsort(-closeness)[:self.nprobe]
+                candidates = np.concatenate([np.array(self.inverted[list_id], dtype=np.int64) for list_id in probe])
+
+        candidates = candidates[states[candidates] == LIVE]
+        if len(exclude):
+            candidates = candidates[~np.isin(candidates, list(exclude))]
+        if not len(candidates):
+            return []
+        scores = vectors[candidates] @ query
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(candidates[i]), float(scores[i])) for i in top]
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+from pymongo import ReturnDocument, UpdateOne
+
+from lazy import LazyModule
+
+cv2 = LazyModule('cv2')
+
+BLOB_NAME = re.compile(r'^([0-9a-f]{64})\.jpg$')
+
+
+class FaceStore:
+    """Content-addressed face crops with a thumbnail variant and reference counting
+
+    A crop is stored once as <root>/<aa>/<bb>/<sha256>.jpg next to <sha256>.thumb.jpg,
+    however many documents reference it. Reference counts live in a Mongo collection and
+    the files are removed when the last reference is released. Names that are not content
+    hashes belong to crops written before this store existed and resolve to <root>/<name>.
+    """
+
+    def __init__(self, root, refs_collection, thumbnail_size=128):
+        self.root = root
+        self.refs = refs_collection
+        self.thumbnail_size = thumbnail_size
+
+    def _digest_path(self, digest, thumbnail=False):
+        suffix = '.thumb.jpg' if thumbnail else '.jpg'
+        return os.path.join(self.root, digest[:2], digest[2:4], digest + suffix)
+
+    def path(self, filename, thumbnail=False):
+        """Return the on-disk path for a face filename, or None if the name is not valid"""
+        match = BLOB_NAME.match(filename)
+        if match:
+            return self._digest_path(match.group(1), thumbnail)
+        if os.path.basename(filename) != filename or filename.startswith('.'):
+            return None
+        # Legacy flat crops have no thumbnail, so the full crop is served instead
+        return os.path.join(self.root, filename)
+
+    def etag(self, filename, thumbnail=False):
+        """Return a strong ETag derived from the crop's content"""
+        match = BLOB_NAME.match(filename)
+        if match:
+            return match.group(1) + ('-thumb' if thumbnail else '')
+        with open(self.path(filename), 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Thread idents repeat across processes, so the pid keeps temp names apart
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _thumbnail(self, jpeg):
+        img = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+        height, width = img.shape[:2]
+        scale = self.thumbnail_size / max(height, width)
+        if scale < 1:
+            img = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                             interpolation=cv2.INTER_AREA)
+        return cv2.imencode('.jpg', img)[1].tobytes()
+
+    def put(self, jpeg):
+        """Store a JPEG crop, taking a reference on it, and return its face filename"""
+        return self.put_many([jpeg])[0]
+
+    def put_many(self, jpegs):
+        """Store JPEG crops, taking one reference per crop in a single round trip; returns their face filenames"""
+        digests = [hashlib.sha256(jpeg).hexdigest() for jpeg in jpegs]
+        if not digests:
+            return []
+        self.refs.bulk_write([UpdateOne({'_id': digest}, {'$inc': {'refs': count}}, upsert=True)
+                              for digest, count in Counter(digests).items()])
+        for digest, jpeg in dict(zip(digests, jpegs)).items():
+            path = self._digest_path(digest)
+            if not os.path.exists(path):
+                self._write(self._digest_path(digest, thumbnail=True), self._thumbnail(jpeg))
+                self._write(path, jpeg)
+        return [f"{digest}.jpg" for digest in digests]
+
+    def _retire(self, digest):
+        """Move a blob's files aside and return them for removal, unless a put re-referenced it meanwhile
+
+        A put that takes a reference after the record was deleted may have found the files
+        still in place and skipped writing them. Renaming first and then re-checking the record
+        means either that put sees the files missing and rewrites them, or the record is seen
+        here and the files are moved back.
+        """
+        moved = []
+        for path in (self._digest_path(digest), self._digest_path(digest, thumbnail=True)):
+            retired = f"{path}.{os.getpid()}.{threading.get_ident()}.retired"
+            try:
+                os.replace(path, retired)
+            except OSError:
+                continue
+            moved.append((path, retired))
+        if self.refs.find_one({'_id': digest}) is not None:
+            for path, retired in moved:
+                os.replace(retired, path)
+            return []
+        return [retired for _, retired in moved]
+
+    def release(self, filename):
+        """Drop one reference to a face filename and delete its files once unreferenced"""
+        match = BLOB_NAME.match(filename)
+        if not match:
+            paths = [self.path(filename)]
+        else:
+            digest = match.group(1)
+            record = self.refs.find_one_and_update(
+                {'_id': digest}, {'$inc': {'refs': -1}}, return_document=ReturnDocument.AFTER
+            )
+            if record is None or record['refs'] > 0:
+                return
+            # Only the caller that removes the record removes the files
+            if self.refs.delete_one({'_id': digest, 'refs': {'$lte': 0}}).deleted_count == 0:
+                return
+            paths = self._retire(digest)
+        for path in paths:
+            if path:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
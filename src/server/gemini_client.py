@@ -0,0 +1,45 @@
+from types import SimpleNamespace
+
+GEMINI_API_URL = 'https://generativelanguage.googleapis.com/v1beta/models'
+
+
+def camel_case(name):
+    head, *rest = name.split('_')
+    return head + ''.join(word.capitalize() for word in rest)
+
+
+class GeminiResponse:
+    def __init__(self, body):
+        self.body = body
+        candidates = body.get('candidates') or []
+        parts = candidates[0].get('content', {}).get('parts', []) if candidates else []
+        self.text = ''.join(part.get('text', '') for part in parts)
+        usage = body.get('usageMetadata', {})
+        self.usage_metadata = SimpleNamespace(
+            prompt_token_count=usage.get('promptTokenCount', 0),
+            candidates_token_count=usage.get('candidatesTokenCount', 0)
+        )
+
+
+class AsyncGeminiModel:
+    """generateContent over the REST API on a shared AsyncHTTPPool
+
+    Stands in for genai.GenerativeModel. generate_content blocks the calling thread until the
+    response arrives, so concurrent Gemini calls are bounded by the threads making them (the
+    upload scheduler's JOB_WORKERS); the pool only shares keep-alive connections between them.
+    generation_config takes the SDK's snake_case keys (response_mime_type, response_schema, ...)
+    and is sent as the request's generationConfig.
+    """
+
+    def __init__(self, pool, api_key, model_name):
+        self.pool = pool
+        self.api_key = api_key
+        self.url = f"{GEMINI_API_URL}/{model_name}:generateContent"
+
+    def generate_content(self, prompt, generation_config=None):
+        payload = {'contents': [{'role': 'user', 'parts': [{'text': prompt}]}]}
+        if generation_config:
+            payload['generationConfig'] = {camel_case(key): value for key, value in generation_config.items()}
+        _, _, body = self.pool.run(self.pool.request('POST', self.url, json=payload,
+                                                     headers={'x-goog-api-key': self.api_key}))
+        return GeminiResponse(body)
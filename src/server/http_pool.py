@@ -0,0 +1,91 @@
+import asyncio
+import threading
+from urllib.parse import urlsplit
+
+import aiohttp
+
+
+class AsyncHTTPPool:
+    """Shared keep-alive HTTP connection pool driven by one event loop on a background thread
+
+    Coroutines are scheduled onto the loop with submit(), which returns a concurrent Future,
+    or run(), which blocks the calling thread for the result. Waiting requests hold a socket
+    slot but no thread. Connections are capped at limit overall and limit_per_host per host;
+    host_limits ({host: n}) caps whole requests to selected hosts, polls included. The loop
+    thread and session are created on first use, so a pool created before a fork works in the child.
+    """
+
+    def __init__(self, limit=100, limit_per_host=32, keepalive=30.0, timeout=30.0, connect_timeout=5.0,
+                 host_limits=None):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.host_limits = host_limits or {}
+        self.loop = None
+        self.session = None
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def _start(self):
+        if self.loop is None:
+            with self.lock:
+                if self.loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='http-pool', daemon=True).start()
+                    self.loop = loop
+        return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the pool's loop and return a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._start())
+
+    def run(self, coro):
+        """Run a coroutine on the pool's loop and wait for its result"""
+        return self.submit(coro).result()
+
+    def _session(self):
+        # Only called on the loop thread, so no locking is needed
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive, ttl_dns_cache=300)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self.session
+
+    def _semaphore(self, host):
+        if host not in self.host_limits:
+            return None
+        if host not in self.semaphores:
+            self.semaphores[host] = asyncio.Semaphore(self.host_limits[host])
+        return self.semaphores[host]
+
+    async def request(self, method, url, **kwargs):
+        """Send a request and return (status, headers, body); JSON bodies are decoded
+
+        Raises aiohttp.ClientResponseError for 4xx/5xx responses and asyncio.TimeoutError
+        when the request exceeds the pool timeout.
+        """
+        semaphore = self._semaphore(urlsplit(url).hostname)
+        if semaphore is None:
+            return await self._request(method, url, **kwargs)
+        async with semaphore:
+            return await self._request(method, url, **kwargs)
+
+    async def _request(self, method, url, **kwargs):
+        async with self._session().request(method, url, **kwargs) as response:
+            if response.content_type == 'application/json':
+                body = await response.json()
+            else:
+                body = await response.read()
+            response.raise_for_status()
+            return response.status, response.headers, body
+
+
+def parse_host_limits(value):
+    """Parse "host=n;host=n" into {host: n}"""
+    limits = {}
+    for item in (value or '').split(';'):
+        if '=' in item:
+            host, limit = item.split('=', 1)
+            limits[host.strip()] = int(limit)
+    return limits
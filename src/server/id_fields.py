@@ -0,0 +1,95 @@
+import re
+from datetime import date
+
+# Bump when a pattern changes so memoized extractions built from old patterns are dropped
+PATTERN_VERSION = '3'
+
+DATE = r'(\d{2})[/\-.](\d{2})[/\-.](\d{4})'
+
+VID_PATTERN = re.compile(r'\bVID\s*[:\-]?\s*(\d{4})\s?(\d{4})\s?(\d{4})\s?(\d{4})\b', re.IGNORECASE)
+# Aadhaar numbers are printed as three space-separated groups and never start with 0 or 1; the
+# groups must be on one line, so a number on its own line is not joined to digits on the next
+AADHAAR_PATTERN = re.compile(r'(?<!\d)(?<!\d )([2-9]\d{3}) (\d{4}) (\d{4})(?! ?\d)')
+PAN_PATTERN = re.compile(r'\b([A-Z]{5}[0-9]{4}[A-Z])\b')
+DOB_PATTERN = re.compile(r'\b(?:DOB|D\.O\.B\.?|Date\s+of\s+Birth)\s*[:\-]?\s*' + DATE, re.IGNORECASE)
+ISSUE_DATE_PATTERN = re.compile(r'\b(?:Issue\s+Date|Date\s+of\s+Issue|Issued\s+on)\s*[:\-]?\s*' + DATE, re.IGNORECASE)
+MOBILE_PATTERN = re.compile(r'(?<!\d)(?:\+91[\s\-]?|0)?([6-9]\d{4})\s?(\d{5})(?!\d)')
+GENDER_PATTERN = re.compile(r'\b(MALE|FEMALE|TRANSGENDER)\b', re.IGNORECASE)
+
+# Verhoeff check digit tables; the last digit of an Aadhaar number is a Verhoeff check digit
+VERHOEFF_MULTIPLY = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 2, 3, 4, 0, 6, 7, 8, 9, 5), (2, 3, 4, 0, 1, 7, 8, 9, 5, 6),
+    (3, 4, 0, 1, 2, 8, 9, 5, 6, 7), (4, 0, 1, 2, 3, 9, 5, 6, 7, 8), (5, 9, 8, 7, 6, 0, 4, 3, 2, 1),
+    (6, 5, 9, 8, 7, 1, 0, 4, 3, 2), (7, 6, 5, 9, 8, 2, 1, 0, 4, 3), (8, 7, 6, 5, 9, 3, 2, 1, 0, 4),
+    (9, 8, 7, 6, 5, 4, 3, 2, 1, 0),
+)
+VERHOEFF_PERMUTE = (
+    (0, 1, 2, 3, 4, 5, 6, 7, 8, 9), (1, 5, 7, 6, 2, 8, 3, 0, 9, 4), (5, 8, 0, 3, 7, 9, 6, 1, 4, 2),
+    (8, 9, 1, 6, 0, 4, 3, 5, 2, 7), (9, 4, 5, 3, 1, 2, 6, 8, 7, 0), (4, 2, 8, 6, 5, 7, 3, 9, 0, 1),
+    (2, 7, 9, 3, 8, 0, 6, 4, 1, 5), (7, 0, 4, 6, 9, 1, 3, 2, 5, 8),
+)
+
+
+def _verhoeff_valid(number):
+    check = 0
+    for position, digit in enumerate(reversed(number)):
+        check = VERHOEFF_MULTIPLY[check][VERHOEFF_PERMUTE[position % 8][int(digit)]]
+    return check == 0
+
+
+def _format_date(match):
+    day, month, year = match.groups()[-3:]
+    try:
+        date(int(year), int(month), int(day))
+    except ValueError:
+        return None
+    return f"{day}/{month}/{year}"
+
+
+def _age_from(dob):
+    day, month, year = (int(part) for part in dob.split('/'))
+    today = date.today()
+    return str(today.year - year - ((today.month, today.day) < (month, day)))
+
+
+def extract_id_fields(ocr_text):
+    """Pull strictly formatted ID fields out of OCR text; fields that are not found are omitted"""
+    fields = {}
+
+    vid_match = VID_PATTERN.search(ocr_text)
+    if vid_match:
+        fields[('Aadhaar Details', 'VID')] = ' '.join(vid_match.groups())
+        # Keep the VID digits from being read as an Aadhaar number
+        ocr_text = ocr_text[:vid_match.start()] + ocr_text[vid_match.end():]
+
+    # Other 12-digit numbers, such as ration card numbers, rarely pass the check digit
+    for aadhaar_match in AADHAAR_PATTERN.finditer(ocr_text):
+        if _verhoeff_valid(''.join(aadhaar_match.groups())):
+            fields[('Aadhaar Details', 'Aadhaar Number')] = ' '.join(aadhaar_match.groups())
+            break
+
+    pan_match = PAN_PATTERN.search(ocr_text)
+    if pan_match:
+        fields[('PAN Details', 'PAN Number')] = pan_match.group(1)
+
+    dob_match = DOB_PATTERN.search(ocr_text)
+    dob = _format_date(dob_match) if dob_match else None
+    if dob:
+        fields[('Personal Information', 'Date of Birth')] = dob
+        fields[('Personal Information', 'Age')] = _age_from(dob)
+
+    issue_match = ISSUE_DATE_PATTERN.search(ocr_text)
+    issue_date = _format_date(issue_match) if issue_match else None
+    if issue_date:
+        fields[('Aadhaar Details', 'Issue Date')] = issue_date
+
+    mobile_match = MOBILE_PATTERN.search(AADHAAR_PATTERN.sub(' ', ocr_text))
+    if mobile_match:
+        fields[('Personal Information', 'Mobile Number')] = ''.join(mobile_match.groups())
+
+    gender_match = GENDER_PATTERN.search(ocr_text)
+    if gender_match:
+        fields[('Personal Information', 'Gender')] = gender_match.group(1).title()
+
+    return fields
+
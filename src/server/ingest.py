@@ -0,0 +1,278 @@
+"""Back-fill an archive of ID document scans through the server's OCR, face detection and
+extraction pipeline, without going through the HTTP API or MongoDB.
+
+Documents come from a directory (walked recursively for png/jpg/jpeg/pdf) or a manifest
+with one path per line, or one JSON object per line with "path" and an optional "id".
+Each document runs through process_ocr, detect_faces and extract_info_with_gemini from
+app.py on a pool of worker processes. At most --max-upstream OCR or Gemini calls are in
+flight across all workers, on top of the server's shared quota buckets.
+
+Results are written in batches as NDJSON lines appended to --output, or as Parquet part
+files in the --output directory. The ids of each written batch are appended to a
+checkpoint file, so an interrupted run resumes after the last written batch. Ids found in
+the output but missing from the checkpoint (a crash between the two writes) are added to it
+on startup, so no batch is written twice. Documents
+that fail go to <output>.errors.ndjson and are retried on the next run. Face crops are
+written to --faces-dir as <sha256>.jpg.
+
+    python ingest.py /archive/scans --output results.ndjson --workers 8
+    python ingest.py manifest.txt --format parquet --output results/ --max-upstream 16
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+DOCUMENT_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.pdf')
+
+# Set in each worker process by init_worker
+pipeline = None
+upstream_slots = None
+faces_dir = None
+
+
+def walk_documents(root):
+    """Yield (id, path) for every document under root, in a stable order; ids are relative paths"""
+    for directory, subdirectories, names in os.walk(root):
+        subdirectories.sort()
+        for name in sorted(names):
+            if name.lower().endswith(DOCUMENT_EXTENSIONS):
+                path = os.path.join(directory, name)
+                yield os.path.relpath(path, root), path
+
+
+def read_manifest(path):
+    """Yield (id, path) from a manifest; relative paths are resolved against its directory"""
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            entry = json.loads(line) if line.startswith('{') else {'path': line}
+            yield entry.get('id', entry['path']), os.path.join(base, entry['path'])
+
+
+class Checkpoint:
+    """Append-only list of finished document ids, fsynced after every batch"""
+
+    def __init__(self, path):
+        self.done = set()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.done.update(line.rstrip('\n') for line in f if line.strip())
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def __contains__(self, document_id):
+        return document_id in self.done
+
+    def record(self, document_ids):
+        self.file.writelines(f"{document_id}\n" for document_id in document_ids)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.update(document_ids)
+
+    def close(self):
+        self.file.close()
+
+
+class NDJSONWriter:
+    def __init__(self, path):
+        self.file = open(path, 'a+', encoding='utf-8')
+
+    def written_ids(self):
+        """Ids already in the file; a partial last line from an interrupted write is cut off"""
+        ids = set()
+        self.file.seek(0)
+        end = 0
+        for line in iter(self.file.readline, ''):
+            if not line.endswith('\n'):
+                break
+            ids.add(json.loads(line)['id'])
+            end = self.file.tell()
+        self.file.truncate(end)
+        return ids
+
+    def write(self, records):
+        self.file.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """One part-NNNNN.parquet per batch; extracted_info is stored as a JSON string to keep the schema fixed"""
+
+    def __init__(self, directory):
+        import pyarrow
+        import pyarrow.parquet
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.part = sum(1 for name in os.listdir(directory) if name.endswith('.parquet'))
+
+    def written_ids(self):
+        return {
+            document_id
+            for name in os.listdir(self.directory) if name.endswith('.parquet')
+            for document_id in self.pq.read_table(os.path.join(self.directory, name), columns=['id'])['id'].to_pylist()
+        }
+
+    def write(self, records):
+        rows = [dict(record, extracted_info=json.dumps(record['extracted_info'], ensure_ascii=False))
+                for record in records]
+        path = os.path.join(self.directory, f"part-{self.part:05d}.parquet")
+        self.pq.write_table(self.pa.Table.from_pylist(rows), f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+        self.part += 1
+
+    def close(self):
+        pass
+
+
+def init_worker(slots, faces_directory):
+    """Import the server pipeline once per worker process"""
+    global pipeline, upstream_slots, faces_dir
+    sys.path.insert(0, SERVER_DIR)
+    os.environ.setdefault('WARMUP_MODE', 'lazy')
+    import app
+
+    pipeline = app
+    upstream_slots = slots
+    faces_dir = faces_directory
+
+
+def save_face(jpeg):
+    name = f"{hashlib.sha256(jpeg).hexdigest()}.jpg"
+    path = os.path.join(faces_dir, name)
+    if not os.path.exists(path):
+        with open(path + f".{os.getpid()}.tmp", 'wb') as f:
+            f.write(jpeg)
+        os.replace(path + f".{os.getpid()}.tmp", path)
+    return name
+
+
+def ingest_document(document_id, path):
+    """Worker entry point: run one document through the pipeline and return its record"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    prepared = pipeline.prepare_upload(data)
+    with upstream_slots:
+        ocr_text = pipeline.process_ocr(prepared.ocr_data, cache_data=data)
+    faces = pipeline.detect_faces(prepared)
+    extracted_info = {}
+    if ocr_text:
+        with upstream_slots:
+            extracted_info = pipeline.extract_info_with_gemini(ocr_text)
+    return {
+        'id': document_id,
+        'path': path,
+        'sha256': hashlib.sha256(data).hexdigest(),
+        'ocr_text': ocr_text,
+        'extracted_info': extracted_info,
+        'faces': [save_face(jpeg) for jpeg in faces],
+        'processed_at': datetime.now().isoformat()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an archive of documents through the extraction pipeline")
+    parser.add_argument('source', help="directory of documents, or a manifest file")
+    parser.add_argument('--output', required=True, help="NDJSON file, or directory for Parquet parts")
+    parser.add_argument('--format', choices=('ndjson', 'parquet'), default='ndjson')
+    parser.add_argument('--checkpoint', help="finished document ids (default: <output>.checkpoint)")
+    parser.add_argument('--faces-dir', default='faces', help="where face crops are written")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-upstream', type=int, default=8,
+                        help="OCR and Gemini calls in flight across all workers")
+    parser.add_argument('--batch-size', type=int, default=100, help="records per write and checkpoint")
+    parser.add_argument('--limit', type=int, help="stop after this many documents")
+    args = parser.parse_args()
+
+    if os.path.isdir(args.source):
+        documents = walk_documents(args.source)
+    else:
+        documents = read_manifest(args.source)
+    output = args.output.rstrip(os.sep)
+    checkpoint = Checkpoint(args.checkpoint or f"{output}.checkpoint")
+    try:
+        writer = ParquetWriter(output) if args.format == 'parquet' else NDJSONWriter(output)
+    except ImportError:
+        parser.error("Parquet output needs pyarrow")
+    recovered = writer.written_ids() - checkpoint.done
+    if recovered:
+        print(f"{len(recovered)} documents in the output were missing from the checkpoint, recording them")
+        checkpoint.record(sorted(recovered))
+    os.makedirs(args.faces_dir, exist_ok=True)
+
+    # spawn keeps the workers free of the parent's threads and of any fork-unsafe model state
+    context = multiprocessing.get_context('spawn')
+    slots = context.BoundedSemaphore(args.max_upstream)
+    pending = set()
+    batch = []
+    completed = failed = skipped = 0
+    start = time.monotonic()
+
+    with open(f"{output}.errors.ndjson", 'a', encoding='utf-8') as errors, \
+            ProcessPoolExecutor(args.workers, mp_context=context, initializer=init_worker,
+                                initargs=(slots, os.path.abspath(args.faces_dir))) as pool:
+
+        def collect(done):
+            nonlocal completed, failed
+            for future in done:
+                document_id, path = pending_ids.pop(future)
+                try:
+                    batch.append(future.result())
+                    completed += 1
+                except Exception as e:
+                    errors.write(json.dumps({'id': document_id, 'path': path, 'error': str(e)}) + '\n')
+                    errors.flush()
+                    failed += 1
+            if len(batch) >= args.batch_size:
+                flush()
+
+        def flush():
+            writer.write(batch)
+            checkpoint.record([record['id'] for record in batch])
+            batch.clear()
+            rate = completed / (time.monotonic() - start)
+            print(f"{completed} documents written ({failed} failed, {skipped} already done), {rate:.2f}/s")
+
+        pending_ids = {}
+        submitted = 0
+        for document_id, path in documents:
+            if document_id in checkpoint:
+                skipped += 1
+                continue
+            if args.limit is not None and submitted >= args.limit:
+                break
+            # Keep only a few documents per worker queued so memory stays flat on large archives
+            if len(pending) >= args.workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            future = pool.submit(ingest_document, document_id, path)
+            pending.add(future)
+            pending_ids[future] = (document_id, path)
+            submitted += 1
+
+        collect(wait(pending).done)
+        if batch:
+            flush()
+
+    writer.close()
+    checkpoint.close()
+    print(f"Done: {completed} written, {failed} failed, {skipped} skipped in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
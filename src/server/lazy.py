@@ -0,0 +1,77 @@
+import importlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LazyModule:
+    """Module proxy that imports the real module on first attribute access"""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+class LazyResource:
+    """Builds an expensive object (model, client) once, on first use or during warmup"""
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self.value = None
+        self.loaded = False
+        self.load_seconds = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.loaded:
+            return self.value
+        with self.lock:
+            if not self.loaded:
+                start = time.monotonic()
+                try:
+                    self.value = self.factory()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.load_seconds = time.monotonic() - start
+                self.error = None
+                self.loaded = True
+        return self.value
+
+    def status(self):
+        return {'loaded': self.loaded, 'load_seconds': self.load_seconds, 'error': self.error}
+
+
+def warm_up(resources, background=True, retry_interval=None):
+    """Load resources now, or on a daemon thread so the server can start serving immediately
+
+    With retry_interval, resources that fail are tried again that many seconds later until they load.
+    """
+    def run():
+        pending = list(resources)
+        while True:
+            failed = []
+            for resource in pending:
+                try:
+                    resource.get()
+                except Exception as e:
+                    logger.error("Warmup of %s failed: %s", resource.name, e)
+                    failed.append(resource)
+            if not failed or retry_interval is None:
+                return
+            pending = failed
+            time.sleep(retry_interval)
+
+    if background:
+        threading.Thread(target=run, name='warmup', daemon=True).start()
+    else:
+        run()
@@ -0,0 +1,72 @@
+import os
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+
+# Set for pre-forking servers: every worker writes its samples here and a scrape merges them.
+# The directory must exist and be emptied before the server starts, and the server's worker-exit
+# hook (gunicorn's child_exit) should call mark_process_dead.
+PROMETHEUS_MULTIPROC_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+
+STAGE_SECONDS = Histogram(
+    'equichain_stage_seconds', 'Duration of upload pipeline stages', ['stage'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+STAGE_IN_FLIGHT = Gauge('equichain_stage_in_flight', 'Pipeline stage calls currently running', ['stage'],
+                        multiprocess_mode='livesum')
+STAGE_ERRORS = Counter('equichain_stage_errors_total', 'Failed pipeline stage calls', ['stage'])
+MODEL_TOKENS = Counter('equichain_model_tokens_total', 'Tokens sent to and received from language models',
+                       ['model', 'direction'])
+
+
+def scrape_registry():
+    """Registry to expose: this process's metrics, or every worker's under PROMETHEUS_MULTIPROC_DIR"""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead(pid):
+    """Drop an exited worker's live gauge samples"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def record_error(stage):
+    """Count a failure that the stage handled itself instead of raising"""
+    STAGE_ERRORS.labels(stage).inc()
+
+
+def record_tokens(model, input_tokens, output_tokens):
+    MODEL_TOKENS.labels(model, 'input').inc(input_tokens)
+    MODEL_TOKENS.labels(model, 'output').inc(output_tokens)
+
+
+@contextmanager
+def track_stage(stage):
+    """Time a block as one call of stage, tracking in-flight calls and raised errors"""
+    STAGE_IN_FLIGHT.labels(stage).inc()
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        record_error(stage)
+        raise
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+        STAGE_IN_FLIGHT.labels(stage).dec()
+
+
+def instrumented(stage):
+    """Decorator form of track_stage"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with track_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
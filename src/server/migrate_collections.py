@@ -0,0 +1,89 @@
+"""Copy legacy per-user collections (user_<id>_documents / user_<id>_faces) into the shared
+documents and faces collections.
+
+The copy keeps each record's _id, so it is idempotent: re-running it, or running it while
+the server keeps writing to the shared collections, never duplicates a record. Source
+collections are only dropped with --drop, and only once every record is present in the
+target.
+
+    python migrate_collections.py [--batch-size 500] [--pause 0.05] [--drop] [--dry-run]
+"""
+import argparse
+import os
+import re
+import time
+
+from dotenv import load_dotenv
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
+
+LEGACY_COLLECTION = re.compile(r'^user_(?P<user_id>.+)_(?P<kind>documents|faces)$')
+DUPLICATE_KEY = 11000
+
+
+def legacy_collections(db):
+    """Yield (name, user_id, kind) for each per-user collection"""
+    for name in sorted(db.list_collection_names()):
+        match = LEGACY_COLLECTION.match(name)
+        if match:
+            yield name, match.group('user_id'), match.group('kind')
+
+
+def copy_batch(target, batch):
+    """Insert a batch, ignoring records that were already copied; returns the number inserted"""
+    try:
+        return len(target.insert_many(batch, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+
+
+def migrate_collection(db, name, user_id, kind, batch_size, pause, drop, dry_run):
+    source = db[name]
+    target = db[kind]
+    total = source.estimated_document_count()
+    print(f"{name} -> {kind}: {total} records")
+    if dry_run:
+        return
+
+    inserted = 0
+    batch = []
+    for record in source.find().sort('_id', 1):
+        record.setdefault('user_id', user_id)
+        batch.append(record)
+        if len(batch) >= batch_size:
+            inserted += copy_batch(target, batch)
+            batch = []
+            # Yield to live traffic between batches
+            time.sleep(pause)
+    if batch:
+        inserted += copy_batch(target, batch)
+    print(f"  copied {inserted} new records")
+
+    if drop:
+        source_ids = [record['_id'] for record in source.find({}, {'_id': 1})]
+        copied = target.count_documents({'_id': {'$in': source_ids}})
+        if copied == len(source_ids):
+            source.drop()
+            print(f"  dropped {name}")
+        else:
+            print(f"  kept {name}: only {copied} of {len(source_ids)} records found in {kind}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate per-user collections into shared collections")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--pause', type=float, default=0.05, help="seconds to sleep between batches")
+    parser.add_argument('--drop', action='store_true', help="drop each legacy collection once fully copied")
+    parser.add_argument('--dry-run', action='store_true', help="only list the collections that would be migrated")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = MongoClient(os.getenv('MONGODB_URI'))['equichain']
+    for name, user_id, kind in legacy_collections(db):
+        migrate_collection(db, name, user_id, kind, args.batch_size, args.pause, args.drop, args.dry_run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+
+import aiohttp
+from azure.cognitiveservices.vision.computervision.models import OperationStatusCodes
+from PIL import Image, UnidentifiedImageError
+
+from ocr_polling import (
+    PENDING_STATUSES, OCRTimeoutError, PollSchedule, operation_id_from, poll_read_result, retry_after_from
+)
+from pdf_pages import is_pdf
+
+logger = logging.getLogger(__name__)
+
+# Azure answers these when a request is throttled, with a Retry-After to wait out
+THROTTLED_STATUSES = (429, 503)
+
+# Tesseract names languages by ISO 639-2 code
+TESSERACT_LANGUAGES = {'en': 'eng', 'hi': 'hin'}
+
+
+class AzureReadBackend:
+    """Azure Computer Vision Read API"""
+
+    name = 'azure'
+
+    def __init__(self, client, quota=None):
+        self.client = client
+        self.quota = quota
+
+    def read(self, image_data, language):
+        """Return the recognized text, or None if the operation failed or timed out"""
+        client = self.client.get()
+        if self.quota is not None:
+            self.quota.wait()
+        raw_response = client.read_in_stream(io.BytesIO(image_data), language=language, raw=True)
+        operation_id = operation_id_from(raw_response)
+
+        try:
+            result = poll_read_result(client, operation_id, retry_after=retry_after_from(raw_response.headers),
+                                      quota=self.quota)
+        except OCRTimeoutError as e:
+            logger.warning("OCR processing timed out: %s", e)
+            return None
+
+        if result.status != OperationStatusCodes.succeeded:
+            logger.warning("OCR processing failed with status %s", result.status)
+            return None
+        all_text = ""
+        for page in result.analyze_result.read_results:
+            for line in page.lines:
+                all_text += line.text + "\n"
+        return all_text
+
+
+class AsyncAzureReadBackend:
+    """Azure Read over REST on a shared AsyncHTTPPool
+
+    read_async submits the image and polls the operation on the pool's event loop, so an
+    in-flight read holds no thread. read is the blocking equivalent for other callers.
+    The submit and every poll take a token from quota, when given, and throttled (429/503)
+    responses are retried after their Retry-After within the operation's deadline.
+    """
+
+    name = 'azure'
+
+    def __init__(self, pool, endpoint, key, quota=None):
+        self.pool = pool
+        # Read at call time, so the server imports without Azure settings
+        self.endpoint = endpoint
+        self.key = key
+        self.quota = quota
+
+    async def _throttle(self):
+        if self.quota is not None:
+            # The reservation is a SQLite transaction; keep its I/O and lock waits off the event loop
+            await asyncio.sleep(await asyncio.to_thread(self.quota.reserve))
+
+    async def _request(self, schedule, method, url, **kwargs):
+        """Send one Read request, waiting out throttling responses until the schedule's deadline"""
+        headers = {'Ocp-Apim-Subscription-Key': self.key, **kwargs.pop('headers', {})}
+        while True:
+            await self._throttle()
+            try:
+                return await self.pool.request(method, url, headers=headers, **kwargs)
+            except aiohttp.ClientResponseError as e:
+                if e.status not in THROTTLED_STATUSES:
+                    raise
+                await asyncio.sleep(schedule.next_delay(retry_after_from(e.headers)))
+
+    async def read_async(self, image_data, language):
+        """Return the recognized text, or None if the operation failed or timed out"""
+        schedule = PollSchedule()
+        try:
+            _, headers, _ = await self._request(
+                schedule, 'POST', f"{self.endpoint.rstrip('/')}/vision/v3.2/read/analyze",
+                params={'language': language}, data=image_data,
+                headers={'Content-Type': 'application/octet-stream'}
+            )
+            operation_url = headers['Operation-Location']
+            retry_after = retry_after_from(headers)
+
+            while True:
+                await asyncio.sleep(schedule.next_delay(retry_after))
+                _, headers, result = await self._request(schedule, 'GET', operation_url)
+                if result['status'] not in PENDING_STATUSES:
+                    break
+                retry_after = retry_after_from(headers)
+        except OCRTimeoutError as e:
+            logger.warning("OCR processing timed out: %s", e)
+            return None
+
+        if result['status'] != 'succeeded':
+            logger.warning("OCR processing failed with status %s", result['status'])
+            return None
+        return ''.join(
+            line['text'] + "\n" for page in result['analyzeResult']['readResults'] for line in page['lines']
+        )
+
+    def read(self, image_data, language):
+        return self.pool.run(self.read_async(image_data, language))
+
+
+def _tesseract_read(image_data, language):
+    """Returns (text, mean word confidence 0-100)"""
+    import pytesseract
+
+    data = pytesseract.image_to_data(
+        Image.open(io.BytesIO(image_data)), lang=language, output_type=pytesseract.Output.DICT
+    )
+    lines = {}
+    confidences = []
+    for word, conf, block, paragraph, line in zip(
+        data['text'], data['conf'], data['block_num'], data['par_num'], data['line_num']
+    ):
+        if word.strip():
+            lines.setdefault((block, paragraph, line), []).append(word)
+            confidences.append(float(conf))
+    text = ''.join(' '.join(words) + '\n' for words in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+class TesseractBackend:
+    """Local CPU OCR through Tesseract, at most workers reads at a time
+
+    pytesseract runs the tesseract binary in a subprocess, so reads run on the calling
+    thread and the CPU work still happens outside this process.
+    """
+
+    name = 'tesseract'
+
+    def __init__(self, workers=2):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def read_with_confidence(self, image_data, language):
+        with self.slots:
+            return _tesseract_read(image_data, TESSERACT_LANGUAGES.get(language, language))
+
+    def read(self, image_data, language):
+        text, _ = self.read_with_confidence(image_data, language)
+        return text
+
+
+class FixtureBackend:
+    """Replays recorded OCR text keyed by the SHA-256 of the image, for offline runs and benchmarks
+
+    Fixtures are <directory>/<sha256>.txt. With a fallback backend, misses are read through it
+    and recorded; without one they return default_text. latency adds a fixed delay per call to
+    stand in for the real service.
+    """
+
+    name = 'fixture'
+
+    def __init__(self, directory, latency=0.0, fallback=None, default_text=None):
+        self.directory = directory
+        self.latency = latency
+        self.fallback = fallback
+        self.default_text = default_text
+        os.makedirs(directory, exist_ok=True)
+
+    def read(self, image_data, language):
+        path = os.path.join(self.directory, f"{hashlib.sha256(image_data).hexdigest()}.txt")
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with open(path, encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        if self.fallback is None:
+            return self.default_text
+        text = self.fallback.read(image_data, language)
+        if text:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return text
+
+
+class RoutingBackend:
+    """Sends small, clean scans to the local engine and everything else to the remote one
+
+    An image is small when it is not a PDF and has at most max_pixels pixels. It counts as
+    clean when the local engine reads it with at least min_confidence mean word confidence;
+    otherwise it is escalated to the remote backend.
+    """
+
+    name = 'routed'
+
+    def __init__(self, local, remote, max_pixels=2_000_000, min_confidence=80.0):
+        self.local = local
+        self.remote = remote
+        self.max_pixels = max_pixels
+        self.min_confidence = min_confidence
+
+    def is_small(self, image_data):
+        if is_pdf(image_data):
+            return False
+        try:
+            width, height = Image.open(io.BytesIO(image_data)).size
+        except (UnidentifiedImageError, OSError):
+            return False
+        return width * height <= self.max_pixels
+
+    def read(self, image_data, language):
+        if self.is_small(image_data):
+            try:
+                text, confidence = self.local.read_with_confidence(image_data, language)
+                if text.strip() and confidence >= self.min_confidence:
+                    return text
+                logger.info("Local OCR confidence %.0f below threshold, using %s", confidence, self.remote.name)
+            except Exception as e:
+                logger.warning("Local OCR failed, using %s: %s", self.remote.name, e)
+        return self.remote.read(image_data, language)
@@ -0,0 +1,67 @@
+import os
+import time
+
+OCR_POLL_INITIAL_DELAY = float(os.getenv('OCR_POLL_INITIAL_DELAY', '0.25'))  # seconds before the first poll
+OCR_POLL_MAX_DELAY = float(os.getenv('OCR_POLL_MAX_DELAY', '2.0'))  # cap for the backoff interval
+OCR_POLL_BACKOFF = float(os.getenv('OCR_POLL_BACKOFF', '1.5'))  # interval multiplier per poll
+OCR_POLL_TIMEOUT = float(os.getenv('OCR_POLL_TIMEOUT', '60'))  # total deadline per operation
+
+PENDING_STATUSES = ('notStarted', 'running')
+
+
+class OCRTimeoutError(TimeoutError):
+    """Raised when an Azure Read operation does not finish before its deadline"""
+
+
+def operation_id_from(raw_response):
+    """Extract the Read operation id from a raw read_in_stream response"""
+    return raw_response.headers["Operation-Location"].split("/")[-1]
+
+
+def retry_after_from(headers):
+    """Return the Retry-After header in seconds, or None if absent or not numeric"""
+    value = headers.get('Retry-After') if headers else None
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class PollSchedule:
+    """Delay schedule for one operation: short first wait, capped exponential backoff, hard deadline"""
+
+    def __init__(self, initial_delay=None, max_delay=None, backoff=None, timeout=None):
+        self.delay = OCR_POLL_INITIAL_DELAY if initial_delay is None else initial_delay
+        self.max_delay = OCR_POLL_MAX_DELAY if max_delay is None else max_delay
+        self.backoff = OCR_POLL_BACKOFF if backoff is None else backoff
+        self.deadline = time.monotonic() + (OCR_POLL_TIMEOUT if timeout is None else timeout)
+
+    def next_delay(self, retry_after=None):
+        """Return how long to wait before the next poll, honouring Retry-After as a floor"""
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise OCRTimeoutError("OCR operation did not complete before the deadline")
+        delay = self.delay if retry_after is None else max(self.delay, retry_after)
+        self.delay = min(self.delay * self.backoff, self.max_delay)
+        return min(delay, remaining)
+
+
+def _get_read_result(client, operation_id):
+    raw = client.get_read_result(operation_id, raw=True)
+    return raw.output, retry_after_from(raw.response.headers)
+
+
+def poll_read_result(client, operation_id, retry_after=None, quota=None, **schedule_options):
+    """Poll an Azure Read operation until it leaves the pending states or the deadline passes
+
+    Each poll first takes a token from quota, when given, since polls count against the Read rate limit.
+    """
+    schedule = PollSchedule(**schedule_options)
+    while True:
+        time.sleep(schedule.next_delay(retry_after))
+        if quota is not None:
+            quota.wait()
+        result, retry_after = _get_read_result(client, operation_id)
+        if result.status not in PENDING_STATUSES:
+            return result
+
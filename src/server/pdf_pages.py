@@ -0,0 +1,26 @@
+import numpy as np
+
+PDF_MAGIC = b'%PDF-'
+
+
+def is_pdf(data):
+    return data[:len(PDF_MAGIC)] == PDF_MAGIC
+
+
+def rasterize_pages(data, dpi=150, max_pages=None):
+    """Yield the pages of a PDF as BGR images, rendering each one only when it is requested
+
+    Only the current page is held in memory, so callers that stop iterating early never pay
+    for the remaining pages.
+    """
+    import fitz  # PyMuPDF
+
+    with fitz.open(stream=data, filetype='pdf') as document:
+        for page_index, page in enumerate(document):
+            if max_pages and page_index >= max_pages:
+                break
+            pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csRGB, alpha=False)
+            rows = np.frombuffer(pixmap.samples, np.uint8).reshape(pixmap.height, pixmap.stride)
+            rgb = rows[:, :pixmap.width * pixmap.n].reshape(pixmap.height, pixmap.width, pixmap.n)
+            del pixmap
+            yield np.ascontiguousarray(rgb[:, :, ::-1])
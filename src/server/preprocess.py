@@ -0,0 +1,60 @@
+import io
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from lazy import LazyModule
+
+cv2 = LazyModule('cv2')
+
+EXIF_ORIENTATION = 0x0112
+
+
+class PreparedImage:
+    """One upload decoded once and shared by OCR and detection
+
+    ocr_data is what Azure receives: the original bytes when they needed no change, otherwise
+    an oriented, downscaled JPEG. image is the oriented BGR image that face crops are cut from,
+    and detection_image is the same picture shrunk to the YOLO input size; box coordinates on
+    detection_image map back to image by dividing by scale. image is None for PDFs and for
+    bytes Pillow cannot decode.
+    """
+
+    def __init__(self, data, ocr_data, image=None, detection_image=None, scale=1.0):
+        self.data = data
+        self.ocr_data = ocr_data
+        self.image = image
+        self.detection_image = detection_image
+        self.scale = scale
+
+
+def prepare_image(data, ocr_max_edge=2048, detection_size=640, jpeg_quality=90):
+    """Decode, orient and downscale an upload once for both OCR and detection"""
+    try:
+        img = Image.open(io.BytesIO(data))
+        original_size = img.size
+        orientation = img.getexif().get(EXIF_ORIENTATION, 1)
+        # JPEGs are decoded straight at a reduced scale when they are far above the target size
+        img.draft('RGB', (ocr_max_edge, ocr_max_edge))
+        img = ImageOps.exif_transpose(img).convert('RGB')
+    except (UnidentifiedImageError, OSError):
+        return PreparedImage(data, data)
+
+    if max(img.size) > ocr_max_edge:
+        img.thumbnail((ocr_max_edge, ocr_max_edge), Image.Resampling.LANCZOS)
+    if orientation != 1 or img.size != original_size:
+        buffer = io.BytesIO()
+        img.save(buffer, 'JPEG', quality=jpeg_quality)
+        ocr_data = buffer.getvalue()
+    else:
+        ocr_data = data
+
+    image = np.ascontiguousarray(np.asarray(img)[:, :, ::-1])
+    height, width = image.shape[:2]
+    scale = detection_size / max(height, width)
+    if scale < 1:
+        detection_image = cv2.resize(image, (max(1, round(width * scale)), max(1, round(height * scale))),
+                                     interpolation=cv2.INTER_AREA)
+    else:
+        detection_image, scale = image, 1.0
+    return PreparedImage(data, ocr_data, image, detection_image, scale)
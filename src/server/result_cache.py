@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class MemoryBackend:
+    """In-process LRU store"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = {'value': value, 'stored_at': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class DiskBackend:
+    """One JSON file per entry; file mtime tracks recency for LRU eviction"""
+
+    def __init__(self, max_entries, directory):
+        self.max_entries = max_entries
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            os.utime(path)
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'value': value, 'stored_at': time.time()}, f)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith('.json')]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+class MongoBackend:
+    """Entries in a shared Mongo collection, evicted by last access time"""
+
+    def __init__(self, max_entries, collection):
+        self.max_entries = max_entries
+        self.collection = collection
+        self.collection.create_index('last_access')
+
+    def get(self, key):
+        return self.collection.find_one_and_update(
+            {'_id': key}, {'$set': {'last_access': time.time()}}, projection={'_id': 0, 'last_access': 0}
+        )
+
+    def set(self, key, value):
+        now = time.time()
+        self.collection.replace_one(
+            {'_id': key}, {'value': value, 'stored_at': now, 'last_access': now}, upsert=True
+        )
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess > 0:
+            stale = [doc['_id'] for doc in self.collection.find({}, {'_id': 1}).sort('last_access', 1).limit(excess)]
+            self.collection.delete_many({'_id': {'$in': stale}})
+
+    def delete(self, key):
+        self.collection.delete_one({'_id': key})
+
+
+class ResultCache:
+    """Content-addressed result cache with TTL and hit/miss counters"""
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(data, *qualifiers):
+        """Hash the content bytes and append qualifiers such as the OCR language or prompt version"""
+        return '-'.join((hashlib.sha256(data).hexdigest(),) + qualifiers)
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss"""
+        entry = self.backend.get(key) if self.backend else None
+        if entry is not None and time.time() - entry['stored_at'] > self.ttl:
+            self.backend.delete(key)
+            entry = None
+        self._count(entry is not None)
+        return entry['value'] if entry is not None else None
+
+    def set(self, key, value):
+        if self.backend:
+            self.backend.set(key, value)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__ if self.backend else None,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0
+            }
+
+
+def create_result_cache(name, backend, max_entries, ttl, db=None, directory=None):
+    """Build a cache on the named backend; name picks the Mongo collection and default cache directory"""
+    if backend == 'memory':
+        store = MemoryBackend(max_entries)
+    elif backend == 'disk':
+        store = DiskBackend(max_entries, directory or name)
+    elif backend == 'mongo':
+        store = MongoBackend(max_entries, db[name])
+    elif backend == 'none':
+        store = None
+    else:
+        raise ValueError(f"Unknown {name} backend: {backend}")
+    return ResultCache(store, ttl)
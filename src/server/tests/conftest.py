@@ -0,0 +1,51 @@
+import os
+import sys
+from types import SimpleNamespace
+
+# Server modules import each other as top-level modules, as they do when run from src/server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class MemoryCollection:
+    """Just enough of a pymongo collection for counters and reference counts: $inc updates by _id"""
+
+    def __init__(self):
+        self.records = {}
+
+    def _matches(self, record, query):
+        for key, condition in query.items():
+            value = record.get(key)
+            if isinstance(condition, dict):
+                if '$lte' in condition and not (value is not None and value <= condition['$lte']):
+                    return False
+            elif value != condition:
+                return False
+        return True
+
+    def find_one(self, query):
+        record = self.records.get(query['_id'])
+        return dict(record) if record is not None and self._matches(record, query) else None
+
+    def find_one_and_update(self, query, update, upsert=False, return_document=False):
+        record = self.records.get(query['_id'])
+        if record is None:
+            if not upsert:
+                return None
+            record = self.records[query['_id']] = {'_id': query['_id']}
+        for key, amount in update['$inc'].items():
+            record[key] = record.get(key, 0) + amount
+        return dict(record)
+
+    def update_one(self, query, update, upsert=False):
+        self.find_one_and_update(query, update, upsert=upsert)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self.update_one(request._filter, request._doc, upsert=request._upsert)
+
+    def delete_one(self, query):
+        record = self.records.get(query['_id'])
+        deleted = record is not None and self._matches(record, query)
+        if deleted:
+            del self.records[query['_id']]
+        return SimpleNamespace(deleted_count=int(deleted))
@@ -0,0 +1,81 @@
+import threading
+
+import pytest
+
+from admission import PriorityScheduler, QueueFullError, QuotaStore, TokenBucket
+
+
+def blocked_scheduler(capacity):
+    """A one-worker scheduler whose worker is stuck on a task until the returned event is set"""
+    scheduler = PriorityScheduler(workers=1, capacity=capacity)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    running = scheduler.submit(1, block)
+    started.wait(1)
+    return scheduler, release, running
+
+
+def test_runs_lowest_priority_number_first():
+    scheduler, release, running = blocked_scheduler(capacity=4)
+    order = []
+    futures = [scheduler.submit(priority, order.append, priority) for priority in (1, 0, 1, 0)]
+    release.set()
+    for future in [running] + futures:
+        future.result(1)
+    assert order == [0, 0, 1, 1]
+
+
+def test_higher_priority_work_displaces_queued_work():
+    scheduler, release, running = blocked_scheduler(capacity=1)
+    queued = scheduler.submit(1, lambda: 'upload')
+    recheck = scheduler.submit(0, lambda: 'recheck')
+    with pytest.raises(QueueFullError) as shed:
+        queued.result(1)
+    assert shed.value.retry_after >= 1
+    release.set()
+    assert recheck.result(1) == 'recheck'
+
+
+def test_displaced_callbacks_run_outside_the_scheduler_lock():
+    scheduler, release, running = blocked_scheduler(capacity=1)
+    queued = scheduler.submit(1, lambda: None)
+    held = []
+    queued.add_done_callback(lambda future: held.append(scheduler.condition._is_owned()))
+    scheduler.submit(0, lambda: None)
+    release.set()
+    assert held == [False]
+
+
+def test_full_queue_sheds_equal_or_lower_priority_work():
+    scheduler, release, running = blocked_scheduler(capacity=1)
+    scheduler.submit(0, lambda: None)
+    with pytest.raises(QueueFullError) as shed:
+        scheduler.submit(0, lambda: None)
+    assert shed.value.retry_after >= 1
+    release.set()
+
+
+def test_token_bucket_reserves_and_reports_delays(tmp_path):
+    bucket = TokenBucket(QuotaStore(str(tmp_path / 'quota.db')), 'azure', rate=1.0, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    # The bucket is empty: a third token takes about a second, and checking does not take it
+    assert bucket.delay_for() == pytest.approx(1, abs=0.1)
+    assert bucket.delay_for() == pytest.approx(1, abs=0.1)
+    assert bucket.reserve() == pytest.approx(1, abs=0.1)
+    assert bucket.reserve() == pytest.approx(2, abs=0.1)
+
+
+def test_buckets_are_shared_through_the_store_file(tmp_path):
+    path = str(tmp_path / 'quota.db')
+    first = TokenBucket(QuotaStore(path), 'gemini', rate=1.0, burst=1)
+    second = TokenBucket(QuotaStore(path), 'gemini', rate=1.0, burst=1)
+    other = TokenBucket(QuotaStore(path), 'azure', rate=1.0, burst=1)
+    assert first.reserve() == 0
+    assert second.reserve() == pytest.approx(1, abs=0.1)
+    assert other.reserve() == 0
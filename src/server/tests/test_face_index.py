@@ -0,0 +1,75 @@
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+
+from conftest import MemoryCollection  # noqa: E402
+from face_index import FaceIndex  # noqa: E402
+
+
+def clustered_vectors(count, dim=32, clusters=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim))
+    return centers[rng.integers(0, clusters, count)] + 0.05 * rng.normal(size=(count, dim))
+
+
+def make_index(tmp_path, counters, **options):
+    options = dict(dict(lists=8, nprobe=8, train_size=200), **options)
+    return FaceIndex(str(tmp_path), 32, counters, **options)
+
+
+def test_add_many_allocates_consecutive_rows(tmp_path):
+    index = make_index(tmp_path, MemoryCollection())
+    vectors = clustered_vectors(5)
+    assert index.add_many(vectors[:3]) == [0, 1, 2]
+    assert index.add(vectors[3]) == 3
+    assert index.add_many([]) == []
+    assert np.allclose(index.vector(1), vectors[1] / np.linalg.norm(vectors[1]), atol=1e-6)
+
+
+@pytest.mark.parametrize('count', [50, 500])
+def test_search_finds_the_nearest_row(tmp_path, count):
+    # 50 rows are scanned in full, 500 go through the trained inverted lists
+    index = make_index(tmp_path, MemoryCollection())
+    vectors = clustered_vectors(count)
+    index.add_many(vectors)
+    (row, score), = index.search(vectors[17], k=1)
+    assert row == 17 and score == pytest.approx(1, abs=1e-5)
+    assert (index.centroids is not None) == (count >= 200)
+
+
+def test_removed_and_excluded_rows_are_not_returned(tmp_path):
+    index = make_index(tmp_path, MemoryCollection())
+    vectors = clustered_vectors(300)
+    index.add_many(vectors)
+    index.remove([17, None])
+    rows = [row for row, _ in index.search(vectors[17], k=300, exclude=[18])]
+    assert 17 not in rows and 18 not in rows
+
+
+def test_rows_written_by_other_processes_are_found(tmp_path):
+    counters = MemoryCollection()
+    writer, reader = make_index(tmp_path, counters), make_index(tmp_path, counters)
+    vectors = clustered_vectors(400)
+    writer.add_many(vectors[:300])
+    reader.search(vectors[0], k=1)
+    writer.add_many(vectors[300:])
+    assert reader.search(vectors[350], k=1)[0][0] == 350
+
+
+def test_unwritten_rows_are_skipped_after_the_grace_period(tmp_path):
+    counters = MemoryCollection()
+    index = make_index(tmp_path, counters, grace=0.2)
+    vectors = clustered_vectors(400)
+    index.add_many(vectors[:250])
+    # Rows allocated by a writer that never wrote them, e.g. another host or a crashed worker
+    counters.find_one_and_update({'_id': index.name}, {'$inc': {'rows': 5}})
+    index.add_many(vectors[250:])
+    assert index.search(vectors[300], k=1)[0][0] != 305
+    assert index.indexed == 250
+    time.sleep(0.3)
+    assert index.search(vectors[300], k=1)[0][0] == 305
+    assert index.indexed == 405
+    assert sum(len(rows) for rows in index.inverted) == 400
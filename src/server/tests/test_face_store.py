@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pymongo')
+cv2 = pytest.importorskip('cv2')
+
+from conftest import MemoryCollection  # noqa: E402
+from face_store import FaceStore  # noqa: E402
+
+
+def jpeg(value):
+    return cv2.imencode('.jpg', np.full((200, 100, 3), value, np.uint8))[1].tobytes()
+
+
+def test_identical_crops_share_one_blob(tmp_path):
+    refs = MemoryCollection()
+    store = FaceStore(str(tmp_path), refs, thumbnail_size=32)
+    first, second, other = store.put_many([jpeg(10), jpeg(10), jpeg(200)])
+    assert first == second != other
+    assert refs.find_one({'_id': first[:-4]})['refs'] == 2
+    assert os.path.exists(store.path(first))
+    thumbnail = cv2.imread(store.path(first, thumbnail=True))
+    assert max(thumbnail.shape[:2]) == 32
+
+
+def test_files_are_removed_when_the_last_reference_is_released(tmp_path):
+    refs = MemoryCollection()
+    store = FaceStore(str(tmp_path), refs)
+    name = store.put(jpeg(10))
+    assert store.put(jpeg(10)) == name
+    store.release(name)
+    assert os.path.exists(store.path(name))
+    store.release(name)
+    assert refs.find_one({'_id': name[:-4]}) is None
+    assert not os.path.exists(store.path(name))
+    assert not os.path.exists(store.path(name, thumbnail=True))
+
+
+def test_released_blob_is_kept_when_re_referenced(tmp_path):
+    refs = MemoryCollection()
+    store = FaceStore(str(tmp_path), refs)
+    name = store.put(jpeg(10))
+    refs.find_one_and_update({'_id': name[:-4]}, {'$inc': {'refs': -1}})
+    refs.delete_one({'_id': name[:-4]})
+    # A put that takes a new reference before the releasing caller retires the files
+    refs.update_one({'_id': name[:-4]}, {'$inc': {'refs': 1}}, upsert=True)
+    assert store._retire(name[:-4]) == []
+    assert os.path.exists(store.path(name))
+
+
+def test_legacy_names_resolve_to_the_root(tmp_path):
+    store = FaceStore(str(tmp_path), MemoryCollection())
+    assert store.path('face_1.jpg') == os.path.join(str(tmp_path), 'face_1.jpg')
+    assert store.path('../face_1.jpg') is None
@@ -0,0 +1,59 @@
+from datetime import date
+
+from id_fields import extract_id_fields
+
+AADHAAR_TEXT = """GOVERNMENT OF INDIA
+Ramesh Kumar
+DOB: 14/08/1990
+MALE
+2345 6789 0124
+VID : 9123 4567 8901 2345
+"""
+
+
+def test_aadhaar_card_fields():
+    fields = extract_id_fields(AADHAAR_TEXT)
+    assert fields[('Aadhaar Details', 'Aadhaar Number')] == '2345 6789 0124'
+    assert fields[('Aadhaar Details', 'VID')] == '9123 4567 8901 2345'
+    assert fields[('Personal Information', 'Date of Birth')] == '14/08/1990'
+    assert fields[('Personal Information', 'Gender')] == 'Male'
+
+
+def test_age_is_a_string():
+    age = extract_id_fields(AADHAAR_TEXT)[('Personal Information', 'Age')]
+    today = date.today()
+    assert age == str(today.year - 1990 - ((today.month, today.day) < (8, 14)))
+
+
+def test_aadhaar_number_on_its_own_line():
+    fields = extract_id_fields('2345 6789 0124\n2 Address')
+    assert fields[('Aadhaar Details', 'Aadhaar Number')] == '2345 6789 0124'
+
+
+def test_aadhaar_number_not_taken_from_longer_digit_runs():
+    assert ('Aadhaar Details', 'Aadhaar Number') not in extract_id_fields('Account 2345 6789 0124 3456')
+    assert ('Aadhaar Details', 'Aadhaar Number') not in extract_id_fields('92345 6789 0124')
+
+
+def test_other_twelve_digit_numbers_are_not_aadhaar_numbers():
+    # Fails the check digit, is not grouped, starts with 1
+    for text in ('Ration Card No. 2345 6789 0123', 'Ration Card No. 234567890124', '1234 5678 9012'):
+        assert ('Aadhaar Details', 'Aadhaar Number') not in extract_id_fields(text)
+
+
+def test_vid_is_not_read_as_aadhaar_number():
+    fields = extract_id_fields('VID: 9123 4567 8901 2345')
+    assert ('Aadhaar Details', 'Aadhaar Number') not in fields
+
+
+def test_pan_and_mobile():
+    fields = extract_id_fields('INCOME TAX DEPARTMENT\nABCDE1234F\nMobile: 98765 43210')
+    assert fields[('PAN Details', 'PAN Number')] == 'ABCDE1234F'
+    assert fields[('Personal Information', 'Mobile Number')] == '9876543210'
+
+
+def test_invalid_date_is_ignored():
+    fields = extract_id_fields('DOB: 31/02/1990')
+    assert ('Personal Information', 'Date of Birth') not in fields
+    assert ('Personal Information', 'Age') not in fields
+